@@ -8,14 +8,21 @@ import os
 from pymongo import MongoClient, errors
 from datetime import datetime
 from bson import ObjectId
-from utils.igdb_api import IGDBAutoAuthClient
+from utils.igdb_api import IGDB_API_RATE_LIMIT_KEY, AsyncIGDBClient, IGDBAutoAuthClient
+from utils.igdb_cache import IGDBResponseCache
+from utils.rate_limit import RedisTokenBucket
+from utils.game_names import add_lookup_names
+from utils.pagination import encode_cursor, decode_cursor, keyset_filter, find_page
+from utils.game_search import name_search_filter, relevance_stage
 from utils.db import get_db
 from utils.user_utils import router as user_utils_router
 from utils.user_utils import get_password_hash, get_current_active_user
 import logging
 from arq import create_pool
 from arq.connections import RedisSettings
+from redis import Redis
 import json
+import uuid
 from bson import ObjectId
 from fastapi import Query
 
@@ -69,9 +76,35 @@ mongo_uri = f"mongodb://{os.getenv('MONGO_INIT_USER')}:{os.getenv('MONGO_INIT_PA
 client = MongoClient(mongo_uri)
 db = client["game_tracker"]
 
+REDIS_URL = "redis://redis:6379"
+redis_client = Redis.from_url(REDIS_URL)
+
+# Code arq per piattaforma, servite da worker separati (vedi sync_worker/worker_sync.py)
+SYNC_QUEUES = {
+    "steam": "sync:steam",
+    "psn": "sync:psn",
+}
+
+# Parte della quota IGDB (4 req/s) riservata all'API, condivisa tra le sue istanze via Redis;
+# il resto va ai worker di sync (IGDB_REQUESTS_PER_SECOND in sync_worker/worker_sync.py)
+IGDB_API_REQUESTS_PER_SECOND = float(os.getenv("IGDB_API_REQUESTS_PER_SECOND", "1"))
+igdb_rate_limiter = RedisTokenBucket(redis_client, IGDB_API_RATE_LIMIT_KEY, IGDB_API_REQUESTS_PER_SECOND)
+
 igdb_client = IGDBAutoAuthClient(
     client_id=os.getenv("IGDB_CLIENT_ID"),
-    client_secret=os.getenv("IGDB_CLIENT_SECRET")
+    client_secret=os.getenv("IGDB_CLIENT_SECRET"),
+    rate_limiter=igdb_rate_limiter,
+    cache=IGDBResponseCache(redis_client),
+    redis_client=redis_client,
+)
+
+# Client IGDB non bloccante per le route async: le chiamate in volo non fermano l'event loop
+async_igdb_client = AsyncIGDBClient(
+    client_id=os.getenv("IGDB_CLIENT_ID"),
+    client_secret=os.getenv("IGDB_CLIENT_SECRET"),
+    rate_limiter=igdb_rate_limiter,
+    cache=igdb_client.cache,
+    redis_client=redis_client,
 )
 
 
@@ -81,7 +114,12 @@ def read_root():
 
 @app.on_event("startup")
 def startup_event():
-    init_mongo()
+    init_mongo(redis_client=redis_client, rate_limiter=igdb_rate_limiter)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await async_igdb_client.aclose()
+    igdb_client.cache.flush_stats()
 
 def user_response(doc: dict) -> dict:
     return {
@@ -157,7 +195,11 @@ def register_user(user: User, db=Depends(get_db)):
                 )
                 
         return {"id": str(result.inserted_id), "email": user.email}
-    except errors.DuplicateKeyError:
+    except errors.DuplicateKeyError as e:
+        if "username" in (e.details or {}).get("keyPattern", {}):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="Username already taken"
+            )
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered"
         )
@@ -261,14 +303,21 @@ async def sync_user_platform(
     current_user: Annotated[User, Depends(get_current_active_user)],
     db=Depends(get_db),
 ):
-    redis_url = "redis://redis:6379"
-    redis = await create_pool(RedisSettings.from_dsn(redis_url))
-    string_job_id = f"{str(current_user.id)}_{platform}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-    job = await redis.enqueue_job("sync_job", str(current_user.id), platform, string_job_id)
-    # Salva lo stato del job in schedules (pending)
+    # Ogni piattaforma ha la sua coda: una sconosciuta non verrebbe mai presa da un worker
+    if platform not in SYNC_QUEUES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid platform. Valid platforms are: {', '.join(SYNC_QUEUES)}",
+        )
+    # Il timestamp ha la risoluzione del secondo: il suffisso rende unico anche un doppio click
+    string_job_id = (
+        f"{str(current_user.id)}_{platform}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:12]}"
+    )
+    # Salva lo stato del job in schedules (pending) prima di accodarlo, così il worker lo trova
+    # sempre; l'id del job arq è lo stesso job_string_id
     db["schedules"].insert_one(
         {
-            "job_id": job.job_id,
+            "job_id": string_job_id,
             "job_string_id": string_job_id,
             "user_id": str(current_user.id),
             "platform": platform,
@@ -277,7 +326,26 @@ async def sync_user_platform(
             "updated_at": datetime.now(),
         }
     )
-    return {"detail": "Sync job queued", "job_id": job.job_id}
+    try:
+        redis = await create_pool(RedisSettings.from_dsn(REDIS_URL))
+        await redis.enqueue_job(
+            "sync_job",
+            str(current_user.id),
+            platform,
+            string_job_id,
+            _job_id=string_job_id,
+            _queue_name=SYNC_QUEUES[platform],
+        )
+    except Exception as e:
+        logging.error(f"Could not enqueue sync job {string_job_id}: {e}")
+        db["schedules"].update_one(
+            {"job_string_id": string_job_id},
+            {"$set": {"status": "fail", "error": "Could not enqueue sync job", "updated_at": datetime.now()}},
+        )
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Sync queue unavailable"
+        )
+    return {"detail": "Sync job queued", "job_id": string_job_id}
 
 #Recupera lo status di un job di sincronizzazione
 @app.get("/sync/status/{job_id}")
@@ -291,24 +359,24 @@ def get_sync_status(job_id: str, db=Depends(get_db)):
 @app.get("/games", response_model=dict)
 def get_all_games(
     db=Depends(get_db),
-    name: str = Query(None, description="Filter games by name (case-insensitive)"),
+    name: str = Query(None, description="Search games by name (whole words or title prefix, case-insensitive)"),
     genres: list[int] = Query(None, description="Filter games by genres (comma-separated)"),
     platforms: list[int] = Query(None, description="Filter games by console (comma-separated)"),
     developer: list[int] = Query(None, description="Filter games by developer"),
     publisher: int = Query(None, description="Filter games by publisher"),
     game_mode: list[int] = Query(None, description="Filter games by game mode (e.g., Single-player, Multiplayer)"),
-    sort_by: str = Query("name", description="Sort games by field (e.g., name, release_date, rating)"),
+    sort_by: str = Query(None, description="Sort games by field (e.g., relevance, name, release_date, rating); relevance by default when searching by name, otherwise name"),
     sort_order: str = Query("asc", description="Sort order (asc or desc)"),
     page: int = Query(1, ge=1, description="Page number (starts from 1)"),
     limit: int = Query(10, ge=1, le=100, description="Number of items per page (max 100)"),
+    cursor: str = Query(None, description="next_cursor of the previous page, alternative to page (skips the total count)"),
 ):
     match_stage = {}
     
-    if name:
-        match_stage["$or"] = [
-            {"name": {"$regex": name, "$options": "i"}},
-            {"original_name": {"$regex": name, "$options": "i"}},
-        ]
+    # Ricerca sul text index di name/original_name e sul prefisso di normalized_name
+    name_filter = name_search_filter(name)
+    if name_filter:
+        match_stage.update(name_filter)
 
     if genres:
         match_stage["genres"] = {"$in": genres}
@@ -325,7 +393,12 @@ def get_all_games(
     if game_mode:
         match_stage["game_modes"] = {"$in": game_mode}
         
+    if sort_by is None:
+        sort_by = "relevance" if name_filter else "name"
+
     valid_sort_fields = ["name", "release_date", "total_rating", "total_rating_count"]
+    if name_filter:
+        valid_sort_fields.append("relevance")
     if sort_by not in valid_sort_fields:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -339,107 +412,57 @@ def get_all_games(
             detail=f"Invalid sort order. Valid orders are: {', '.join(valid_sort_orders)}"
         )
         
-    sort_direction = 1 if sort_order == "asc" else -1
-    sort_stage = {sort_by: sort_direction}
-        
-    pipeline = [
-        {"$match": match_stage} if match_stage else {"$match": {}},
-        # Lookup per i generi
-        {
-            "$lookup": {
-                "from": "genres",
-                "localField": "genres",
-                "foreignField": "igdb_id",
-                "as": "genre_details",
-            }
-        },
-        # Lookup per le piattaforme
-        {
-            "$lookup": {
-                "from": "console_platforms",
-                "localField": "platforms",
-                "foreignField": "igdb_id",
-                "as": "platform_details",
-            }
-        },
-        # Lookup per il developer
-        {
-            "$lookup": {
-                "from": "companies",
-                "localField": "developer",
-                "foreignField": "igdb_id",
-                "as": "developer_details",
-            }
-        },
-        # Lookup per il publisher
-        {
-            "$lookup": {
-                "from": "companies",
-                "localField": "publisher",
-                "foreignField": "igdb_id",
-                "as": "publisher_details",
-            }
-        },
-        # Lookup per le modalità di gioco
-        {
-            "$lookup": {
-                "from": "game_modes",
-                "localField": "game_modes",
-                "foreignField": "igdb_id",
-                "as": "game_mode_details",
-            }
-        },
-        # Aggiungi campi computati per i nomi
-        {
-            "$addFields": {
-                "genre_names": "$genre_details.genre_name",
-                "platform_names": "$platform_details.platform_name",
-                "developer_names": "$developer_details.company_name",
-                "publisher_names": "$publisher_details.company_name",
-                "game_mode_names": "$game_mode_details.game_mode_name",
-            },
-        },
-        # Rimuovi i campi di dettaglio se non li vuoi nel risultato finale
-        {
-            "$project": {
-                "genre_details": 0,
-                "platform_details": 0,
-                "developer_details": 0,
-                "publisher_details": 0,
-                "game_mode_details": 0,
-            }
-        },
-        {"$sort": sort_stage},
-        {
-            "$facet": {
-                "games": [{"$skip": (page - 1) * limit}, {"$limit": limit}],
-                "total_count": [{"$count": "count"}],
-            }
-        },
-    ]
+    # La rilevanza ha senso solo dalla più alta
+    sort_direction = 1 if sort_order == "asc" and sort_by != "relevance" else -1
+    # _id come secondo campo rende stabile l'ordine tra pagine a parità di valore
+    sort_stage = [(sort_by, sort_direction), ("_id", sort_direction)]
                 
     logging.info(f"Querying games with filters: {match_stage} on page {page} with limit {limit}")
         
-    result = list(db["games"].aggregate(pipeline))
-    games = result[0]["games"] if result else []
-    total_count = result[0]["total_count"][0]["count"] if result and result[0]["total_count"] else 0
+    # I nomi di generi, piattaforme, compagnie e modalità sono già sul documento:
+    # la pagina è un find con sort + skip + limit (o dal cursore) e il totale un conteggio separato
+    if sort_by == "relevance":
+        # Il punteggio è calcolato, quindi serve una pipeline: cursore e paginazione vengono dopo
+        pipeline = [{"$match": match_stage}, relevance_stage(name)]
+        if cursor:
+            pipeline.append({"$match": keyset_filter(sort_stage, decode_cursor(cursor, sort_stage))})
+        pipeline += [
+            {"$sort": dict(sort_stage)},
+            {"$skip": 0 if cursor else (page - 1) * limit},
+            {"$limit": limit + 1},
+        ]
+        games = list(db["games"].aggregate(pipeline))
+        next_cursor = encode_cursor(sort_stage, games[limit - 1]) if len(games) > limit else None
+        games = games[:limit]
+    else:
+        games, next_cursor = find_page(
+            db["games"], match_stage, sort_stage, limit, cursor=cursor, skip=(page - 1) * limit
+        )
     
     for game in games:
         game["_id"] = str(game["_id"])
         
-    total_pages = (total_count + limit - 1) // limit  # Calcola il numero totale di pagine
-    has_next = page < total_pages
-    has_prev = page > 1
+    if cursor:
+        # Scorrimento a cursore: nessun conteggio, la pagina successiva esiste se c'è next_cursor
+        total_count = total_pages = None
+        has_next = next_cursor is not None
+        has_prev = True
+    else:
+        total_count = db["games"].count_documents(match_stage)
+        total_pages = (total_count + limit - 1) // limit  # Calcola il numero totale di pagine
+        has_next = page < total_pages
+        has_prev = page > 1
         
     return {
         "games": games,
         "pagination": {
-            "current_page": page,
+            "current_page": None if cursor else page,
             "total_pages": total_pages,
             "total_count": total_count,
             "items_per_page": limit,
             "has_next": has_next,
             "has_prev": has_prev,
+            "next_cursor": next_cursor,
         },
         "sorting" : {
             "sort_by": sort_by,
@@ -456,6 +479,7 @@ def get_all_companies(
     country: str = Query(None, description="Filter companies by country (e.g., USA, Japan)"),
     page: int = Query(1, ge=1, description="Page number (starts from 1)"),
     limit: int = Query(10, ge=1, le=100, description="Number of items per page (max 100)"),
+    cursor: str = Query(None, description="next_cursor of the previous page, alternative to page (skips the total count)"),
 ):
     query = {}
     
@@ -464,31 +488,35 @@ def get_all_companies(
     if country:
         query["country"] = {"$regex": country, "$options": "i"}
     
-    # Calcola il numero totale di aziende che corrispondono ai filtri
-    total_count = db["companies"].count_documents(query)
-    
     # Calcola skip per la paginazione
     skip = (page - 1) * limit
     
-    # Recupera le aziende con paginazione
-    companies = list(db["companies"].find(query).skip(skip).limit(limit))
+    # Recupera le aziende con paginazione, in ordine di _id per poter proseguire dal cursore
+    companies, next_cursor = find_page(db["companies"], query, [("_id", 1)], limit, cursor=cursor, skip=skip)
     for company in companies:
         company["_id"] = str(company["_id"])
     
-    # Calcola informazioni di paginazione
-    total_pages = (total_count + limit - 1) // limit
-    has_next = page < total_pages
-    has_prev = page > 1
+    # Calcola informazioni di paginazione (senza conteggio quando si scorre a cursore)
+    if cursor:
+        total_count = total_pages = None
+        has_next = next_cursor is not None
+        has_prev = True
+    else:
+        total_count = db["companies"].count_documents(query)
+        total_pages = (total_count + limit - 1) // limit
+        has_next = page < total_pages
+        has_prev = page > 1
     
     return {
         "companies": companies,
         "pagination": {
-            "current_page": page,
+            "current_page": None if cursor else page,
             "total_pages": total_pages,
             "total_count": total_count,
             "items_per_page": limit,
             "has_next": has_next,
             "has_prev": has_prev,
+            "next_cursor": next_cursor,
         }
     }
 
@@ -500,37 +528,42 @@ def get_all_genres(
     name: str = Query(None, description="Filter genres by name (case-insensitive)"),
     page: int = Query(1, ge=1, description="Page number (starts from 1)"),
     limit: int = Query(20, ge=1, le=100, description="Number of items per page (max 100)"),
+    cursor: str = Query(None, description="next_cursor of the previous page, alternative to page (skips the total count)"),
 ):
     query = {}
 
     if name:
         query["genre_name"] = {"$regex": name, "$options": "i"}
 
-    # Calcola il numero totale di generi che corrispondono ai filtri
-    total_count = db["genres"].count_documents(query)
-    
     # Calcola skip per la paginazione
     skip = (page - 1) * limit
     
-    # Recupera i generi con paginazione
-    genres = list(db["genres"].find(query).skip(skip).limit(limit))
+    # Recupera i generi con paginazione, in ordine di _id per poter proseguire dal cursore
+    genres, next_cursor = find_page(db["genres"], query, [("_id", 1)], limit, cursor=cursor, skip=skip)
     for genre in genres:
         genre["_id"] = str(genre["_id"])
     
-    # Calcola informazioni di paginazione
-    total_pages = (total_count + limit - 1) // limit
-    has_next = page < total_pages
-    has_prev = page > 1
+    # Calcola informazioni di paginazione (senza conteggio quando si scorre a cursore)
+    if cursor:
+        total_count = total_pages = None
+        has_next = next_cursor is not None
+        has_prev = True
+    else:
+        total_count = db["genres"].count_documents(query)
+        total_pages = (total_count + limit - 1) // limit
+        has_next = page < total_pages
+        has_prev = page > 1
     
     return {
         "genres": genres,
         "pagination": {
-            "current_page": page,
+            "current_page": None if cursor else page,
             "total_pages": total_pages,
             "total_count": total_count,
             "items_per_page": limit,
             "has_next": has_next,
             "has_prev": has_prev,
+            "next_cursor": next_cursor,
         }
     }
 
@@ -542,37 +575,42 @@ def get_all_game_modes(
     name: str = Query(None, description="Filter game_modes by name (case-insensitive)"),
     page: int = Query(1, ge=1, description="Page number (starts from 1)"),
     limit: int = Query(20, ge=1, le=100, description="Number of items per page (max 100)"),
+    cursor: str = Query(None, description="next_cursor of the previous page, alternative to page (skips the total count)"),
 ):
     query = {}
 
     if name:
         query["game_mode_name"] = {"$regex": name, "$options": "i"}
 
-    # Calcola il numero totale di modalità che corrispondono ai filtri
-    total_count = db["game_modes"].count_documents(query)
-    
     # Calcola skip per la paginazione
     skip = (page - 1) * limit
     
-    # Recupera le modalità con paginazione
-    game_modes = list(db["game_modes"].find(query).skip(skip).limit(limit))
+    # Recupera le modalità con paginazione, in ordine di _id per poter proseguire dal cursore
+    game_modes, next_cursor = find_page(db["game_modes"], query, [("_id", 1)], limit, cursor=cursor, skip=skip)
     for game_mode in game_modes:
         game_mode["_id"] = str(game_mode["_id"])
     
-    # Calcola informazioni di paginazione
-    total_pages = (total_count + limit - 1) // limit
-    has_next = page < total_pages
-    has_prev = page > 1
+    # Calcola informazioni di paginazione (senza conteggio quando si scorre a cursore)
+    if cursor:
+        total_count = total_pages = None
+        has_next = next_cursor is not None
+        has_prev = True
+    else:
+        total_count = db["game_modes"].count_documents(query)
+        total_pages = (total_count + limit - 1) // limit
+        has_next = page < total_pages
+        has_prev = page > 1
     
     return {
         "game_modes": game_modes,
         "pagination": {
-            "current_page": page,
+            "current_page": None if cursor else page,
             "total_pages": total_pages,
             "total_count": total_count,
             "items_per_page": limit,
             "has_next": has_next,
             "has_prev": has_prev,
+            "next_cursor": next_cursor,
         }
     }
 
@@ -734,6 +772,9 @@ def add_to_wishlist(
                 "toVerify": False,
             }
 
+            # Nomi di generi, piattaforme, compagnie e modalità salvati sul gioco per /games
+            add_lookup_names(db, [game_doc])
+
             # Inserisci il gioco nel database
             try:
                 result = db["games"].insert_one(game_doc)
@@ -1129,6 +1170,7 @@ def get_all_sync_by_user(
     platform: str = Query(None, description="Filter by platform"),
     page: int = Query(1, ge=1, description="Page number (starts from 1)"),
     limit: int = Query(20, ge=1, le=100, description="Number of items per page (max 100)"),
+    cursor: str = Query(None, description="next_cursor of the previous page, alternative to page (skips the total count)"),
 ):
     query = {"user_id": str(current_user.id)}
     
@@ -1141,11 +1183,13 @@ def get_all_sync_by_user(
     # Calcola skip per paginazione
     skip = (page - 1) * limit
     
-    # Ottieni il totale dei job per questo utente
-    total_count = db["schedules"].count_documents(query)
+    # Ottieni i job con paginazione, dal più recente; _id rende l'ordine univoco per il cursore
+    jobs, next_cursor = find_page(
+        db["schedules"], query, [("updated_at", -1), ("_id", -1)], limit, cursor=cursor, skip=skip
+    )
     
-    # Ottieni i job con paginazione
-    jobs = list(db["schedules"].find(query).sort("updated_at", -1).skip(skip).limit(limit))
+    # Ottieni il totale dei job per questo utente (non serve quando si scorre a cursore)
+    total_count = None if cursor else db["schedules"].count_documents(query)
     
     for job in jobs:
         job["_id"] = str(job["_id"])
@@ -1155,14 +1199,22 @@ def get_all_sync_by_user(
     return {
         "jobs": jobs,
         "total_count": total_count,
-        "page": page,
+        "page": None if cursor else page,
         "limit": limit,
-        "total_pages": (total_count + limit - 1) // limit
+        "total_pages": None if cursor else (total_count + limit - 1) // limit,
+        "next_cursor": next_cursor,
     }
 
+# Statistiche della cache delle risposte IGDB (hit/miss per endpoint)
+@app.get("/igdb/cache/stats", response_model=dict)
+def get_igdb_cache_stats(
+    current_user: Annotated[User, Depends(get_current_active_user)],
+):
+    return igdb_client.cache.stats()
+
 # Search games from IGDB API with filters for name, platform, and company
 @app.get("/search/igdb", response_model=dict)
-def search_igdb_games(
+async def search_igdb_games(
     current_user: Annotated[User, Depends(get_current_active_user)],
     db=Depends(get_db),
     name: str = Query(None, description="Search games by name"),
@@ -1226,7 +1278,7 @@ def search_igdb_games(
         logging.info(f"IGDB Search Query: {query}")
 
         # Esegui la query
-        response = igdb_client.query("games", query)
+        response = await async_igdb_client.query("games", query)
         games = json.loads(response) if response else []
 
         # Processa i risultati
@@ -1477,6 +1529,9 @@ def add_game_from_igdb(
                 "toVerify": False,
             }
 
+            # Nomi di generi, piattaforme, compagnie e modalità salvati sul gioco per /games
+            add_lookup_names(db, [game_doc])
+
             # Inserisci il gioco nel database
             try:
                 result = db["games"].insert_one(game_doc)
@@ -1680,6 +1735,7 @@ def update_game_metadata(
             "total_rating_count": metadata.get("total_rating_count", 0),
             "toVerify": False,  # Reset verification status on update
         }
+        add_lookup_names(db, [update_doc])
 
         updated_game = db["games"].find_one_and_update(
             {"_id": oid}, {"$set": update_doc}, return_document=True
@@ -1799,6 +1855,7 @@ def get_user_library(
     sort_order: str = Query("asc", description="Ordine: asc o desc"),
     page: int = Query(1, ge=1, description="Numero di pagina"),
     limit: int = Query(20, ge=1, le=100, description="Elementi per pagina"),
+    cursor: str = Query(None, description="next_cursor della pagina precedente, in alternativa a page (senza conteggio)"),
 ):
     #Recupera la libreria di giochi per l'utente corrente 
     try:
@@ -1809,8 +1866,46 @@ def get_user_library(
         if platform:
             match_conditions["platform"] = platform
 
-        pipeline = [
-            {"$match": match_conditions},
+        #Ordinamento
+        valid_sort_fields = ["name", "total_play_count", "total_num_trophies"]
+        if sort_by not in valid_sort_fields:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Campo di ordinamento non valido. Validi: {', '.join(valid_sort_fields)}",
+            )
+
+        sort_direction = -1 if sort_order == "desc" else 1
+        skip_amount = (page - 1) * limit
+
+        # Solo i giochi ancora presenti in games, come faceva l'$unwind dopo la $lookup
+        game_ids = db["game_user"].distinct("game_id", match_conditions)
+        sort = [(sort_by, sort_direction), ("_id", sort_direction)]
+        next_cursor = None
+        if sort_by == "name":
+            # Ordinamento e paginazione sull'indice name di games, poi si idratano solo i giochi della pagina
+            existing_games = {"_id": {"$in": game_ids}}
+            total_count = None if cursor else db["games"].count_documents(existing_games)
+            page_games, next_cursor = find_page(
+                db["games"], existing_games, sort, limit, cursor=cursor, skip=skip_amount
+            )
+            page_ids = [game["_id"] for game in page_games]
+            page_stages = [{"$match": {**match_conditions, "game_id": {"$in": page_ids}}}]
+            sort_stages = []
+        else:
+            # I totali sono calcolati dal raggruppamento di game_user, senza join
+            existing_ids = [game["_id"] for game in db["games"].find({"_id": {"$in": game_ids}}, {"_id": 1})]
+            total_count = None if cursor else len(existing_ids)
+            page_stages = [{"$match": {**match_conditions, "game_id": {"$in": existing_ids}}}]
+            # Con il cursore si riparte dopo l'ultima chiave (totale, _id) invece di saltare le righe
+            after_cursor = [{"$match": keyset_filter(sort, decode_cursor(cursor, sort))}] if cursor else []
+            sort_stages = after_cursor + [
+                {"$sort": {sort_by: sort_direction, "_id": sort_direction}},
+                {"$skip": 0 if cursor else skip_amount},
+                # Una riga in più dice se esiste una pagina successiva
+                {"$limit": limit + 1},
+            ]
+
+        pipeline = page_stages + [
             {
                 "$addFields": {
                     "console_array": {
@@ -1828,47 +1923,9 @@ def get_user_library(
                     }
                 }
             },
-            {
-                "$lookup": {
-                    "from": "games",
-                    "localField": "game_id",
-                    "foreignField": "_id",
-                    "as": "game_details",
-                }
-            },
-            {"$unwind": "$game_details"},
-            {
-                "$lookup": {
-                    "from": "console_platforms",
-                    "localField": "console_array",  # Usa il nuovo campo convertito
-                    "foreignField": "igdb_id",
-                    "as": "console_details",
-                }
-            },
-            {
-                "$project": {
-                    "game_id": 1,
-                    "user_id": 1,
-                    "platform": 1,
-                    "num_trophies": 1,
-                    "play_count": 1,
-                    "console": "$console_array",  # Usa il campo convertito
-                    "console_details": 1,
-                    "game_details": {
-                        "_id": 1,
-                        "name": 1,
-                        "cover_image": 1,
-                        "platforms": 1,
-                        "release_date": 1,
-                        "total_rating": 1,
-                    },
-                }
-            },
             {
                 "$group": {
                     "_id": "$game_id",
-                    "name": {"$first": "$game_details.name"},
-                    "cover_image": {"$first": "$game_details.cover_image"},
                     "platforms_data": {
                         "$push": {
                             "platform": "$platform",
@@ -1882,18 +1939,13 @@ def get_user_library(
                                 }
                             },
                             "num_trophies": {"$toInt": "$num_trophies"},
-                            "console": "$console",
-                            "console_details": "$console_details",
+                            "console": "$console_array",
                         }
                     },
                 }
             },
             {
                 "$project": {
-                    "_id": 0,
-                    "game_id": {"$toString": "$_id"},
-                    "name": 1,
-                    "cover_image": 1,
                     "own_platforms": "$platforms_data.platform",
                     "console": {
                         "$reduce": {
@@ -1985,70 +2037,62 @@ def get_user_library(
                     "total_num_trophies": {"$sum": "$platforms_data.num_trophies"},
                 }
             },
-        ]
-
-        #Ordinamento
-        valid_sort_fields = ["name", "total_play_count", "total_num_trophies"]
-        if sort_by not in valid_sort_fields:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Campo di ordinamento non valido. Validi: {', '.join(valid_sort_fields)}",
-            )
-
-        sort_direction = -1 if sort_order == "desc" else 1
-        pipeline.append({"$sort": {sort_by: sort_direction}})
-
-        #Paginazione con $facet
-        skip_amount = (page - 1) * limit
-        pipeline.append(
+        ] + sort_stages + [
+            # Join con games solo per le righe della pagina
             {
-                "$facet": {
-                    "library": [{"$skip": skip_amount}, {"$limit": limit}],
-                    "pagination_info": [{"$count": "total_count"}],
+                "$lookup": {
+                    "from": "games",
+                    "localField": "_id",
+                    "foreignField": "_id",
+                    "as": "game_details",
                 }
-            }
-        )
+            },
+            {"$unwind": "$game_details"},
+            {
+                "$addFields": {
+                    "game_id": {"$toString": "$_id"},
+                    "name": "$game_details.name",
+                    "cover_image": "$game_details.cover_image",
+                }
+            },
+            {"$project": {"_id": 0, "game_details": 0}},
+        ]
 
         # Esecuzione della pipeline
         try:
-            result = list(db["game_user"].aggregate(pipeline))
+            library_data = list(db["game_user"].aggregate(pipeline))
         except Exception as e:
             logging.error(f"Error in library aggregation pipeline: {e}")
             raise HTTPException(
                 status_code=500,
                 detail=f"Error processing library data: {str(e)}"
             )
+        if sort_by == "name":
+            # Stesso ordine della pagina letta da games
+            position = {str(game_id): i for i, game_id in enumerate(page_ids)}
+            library_data.sort(key=lambda game: position[game["game_id"]])
+        elif len(library_data) > limit:
+            library_data = library_data[:limit]
+            last = library_data[-1]
+            next_cursor = encode_cursor(sort, {sort_by: last[sort_by], "_id": ObjectId(last["game_id"])})
 
         # Formattazione della risposta finale
-        if not result or not result[0]["library"]:
-            return {
-                "library": [],
-                "pagination": {
-                    "total_count": 0,
-                    "total_pages": 0,
-                    "current_page": page,
-                    "limit": limit,
-                },
-            }
-
-        library_data = result[0]["library"]
-        total_count = (
-            result[0]["pagination_info"][0]["total_count"]
-            if result[0]["pagination_info"]
-            else 0
-        )
-        total_pages = (total_count + limit - 1) // limit
+        total_pages = None if cursor else (total_count + limit - 1) // limit
 
         return {
             "library": library_data,
             "pagination": {
                 "total_count": total_count,
                 "total_pages": total_pages,
-                "current_page": page,
+                "current_page": None if cursor else page,
                 "limit": limit,
+                "next_cursor": next_cursor,
             },
         }
 
+    except HTTPException:
+        # Ordinamento o cursore non validi: restano errori 400
+        raise
     except Exception as e:
         logging.error(
             f"Errore nel recuperare la libreria per l'utente {current_user.id}: {e}"
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Il backend importa i propri moduli come `utils.*`, dalla cartella dell'app
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
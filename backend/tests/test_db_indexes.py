@@ -0,0 +1,74 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from pymongo import ASCENDING
+
+from utils.db_indexes import MIGRATIONS_COLLECTION, INDEX_MIGRATION_ID, apply_index_migrations
+
+MIGRATIONS = {
+    1: [
+        {
+            "collection": "users",
+            "keys": [("email", ASCENDING)],
+            "options": {"unique": True},
+            "serves": "test",
+        },
+        {
+            "collection": "game_user",
+            "keys": [("user_id", ASCENDING), ("game_id", ASCENDING)],
+            "options": {"unique": True},
+            "dedupe": True,
+            "serves": "test",
+        },
+    ],
+    2: [
+        {
+            "collection": "games",
+            "keys": [("name", ASCENDING), ("_id", ASCENDING)],
+            "options": {},
+            "serves": "test",
+        },
+    ],
+}
+
+
+@pytest.fixture
+def db():
+    db = mongomock.MongoClient()["game_tracker"]
+    db["users"].insert_many([{"email": "a@example.com"}, {"email": "a@example.com"}])
+    db["game_user"].insert_many(
+        [
+            {"user_id": "u1", "game_id": "g1", "play_count": 1},
+            {"user_id": "u1", "game_id": "g1", "play_count": 2},
+            {"user_id": "u1", "game_id": "g2", "play_count": 3},
+        ]
+    )
+    return db
+
+
+def test_failed_index_does_not_block_later_versions(db):
+    report = apply_index_migrations(db, MIGRATIONS)
+
+    statuses = {(row["collection"], row["version"]): row["status"] for row in report}
+    assert statuses[("users", 1)].startswith("failed")
+    assert statuses[("game_user", 1)] == "ok"
+    assert statuses[("games", 2)] == "ok"
+    assert "name_1__id_1" in db["games"].index_information()
+    # La versione 1 resta da completare e viene riprovata al prossimo avvio
+    assert db[MIGRATIONS_COLLECTION].find_one({"_id": INDEX_MIGRATION_ID}) is None
+
+
+def test_dedupe_keeps_latest_document(db):
+    apply_index_migrations(db, MIGRATIONS)
+
+    rows = sorted(db["game_user"].find({}, {"_id": 0}), key=lambda row: row["game_id"])
+    assert [row["play_count"] for row in rows] == [2, 3]
+
+
+def test_version_is_recorded_once_every_index_is_built(db):
+    apply_index_migrations(db, MIGRATIONS)
+    db["users"].delete_one({"email": "a@example.com"})
+
+    apply_index_migrations(db, MIGRATIONS)
+    assert db[MIGRATIONS_COLLECTION].find_one({"_id": INDEX_MIGRATION_ID})["version"] == 2
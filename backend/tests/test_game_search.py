@@ -0,0 +1,36 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from utils.game_search import name_search_filter, normalize_name
+
+
+@pytest.fixture
+def games():
+    games = mongomock.MongoClient()["game_tracker"]["games"]
+    games.insert_many(
+        [
+            {"name": name, "normalized_name": normalize_name(name)}
+            for name in ["God of War", "God of War Ragnarök", "Lord of the Rings", "Ghost of Tsushima", "War Thunder"]
+        ]
+    )
+    return games
+
+
+def matching_names(games, query):
+    # mongomock non ha il text index: si verifica la parte che richiede tutte le parole
+    word_filter = {"$and": name_search_filter(query)["$and"]}
+    return sorted(game["name"] for game in games.find(word_filter))
+
+
+def test_multi_word_search_requires_every_word(games):
+    assert matching_names(games, "god of war") == ["God of War", "God of War Ragnarök"]
+
+
+def test_last_word_matches_as_prefix(games):
+    assert matching_names(games, "God of Wa") == ["God of War", "God of War Ragnarök"]
+    assert matching_names(games, "of tsu") == ["Ghost of Tsushima"]
+
+
+def test_empty_search_has_no_filter():
+    assert name_search_filter(" ?! ") is None
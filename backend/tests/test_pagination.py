@@ -0,0 +1,64 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+pytest.importorskip("fastapi")
+
+from utils.data_migrations import apply_data_migrations
+from utils.game_names import backfill_lookup_names
+from utils.pagination import find_page
+
+
+def page_through(collection, sort, limit=2):
+    names, cursor = [], None
+    while True:
+        docs, cursor = find_page(collection, {}, sort, limit, cursor=cursor)
+        names.extend(doc["name"] for doc in docs)
+        if cursor is None:
+            return names
+
+
+@pytest.fixture
+def db():
+    db = mongomock.MongoClient()["game_tracker"]
+    db["games"].insert_many(
+        [
+            {"name": "a", "release_date": 1700000000},
+            {"name": "b", "release_date": ""},
+            {"name": "c", "release_date": 1500000000},
+            {"name": "d", "release_date": None},
+            {"name": "e"},
+            {"name": "f", "release_date": ""},
+            {"name": "g", "release_date": 1600000000},
+        ]
+    )
+    return db
+
+
+@pytest.mark.parametrize("direction", [1, -1])
+def test_cursor_reaches_games_without_release_date(db, direction):
+    apply_data_migrations(db)
+    assert db["games"].count_documents({"release_date": ""}) == 0
+
+    sort = [("release_date", direction), ("_id", direction)]
+    names = page_through(db["games"], sort)
+
+    expected = [game["name"] for game in db["games"].find({}).sort(sort)]
+    assert names == expected
+    assert sorted(names) == ["a", "b", "c", "d", "e", "f", "g"]
+
+
+def test_data_migrations_run_once(db):
+    assert apply_data_migrations(db) == ["release_date_null", "lookup_names"]
+    db["games"].insert_one({"name": "h", "release_date": ""})
+    assert apply_data_migrations(db) == []
+
+
+def test_backfill_lookup_names_walks_every_game_once(db):
+    db["genres"].insert_one({"igdb_id": 5, "genre_name": "Shooter"})
+    db["games"].update_many({}, {"$set": {"genres": [5]}})
+    db["games"].update_one({"name": "c"}, {"$set": {"genre_names": ["Old"]}})
+
+    assert backfill_lookup_names(db, batch_size=2) == 6
+    assert db["games"].count_documents({"genre_names": ["Shooter"]}) == 6
+    assert db["games"].find_one({"name": "c"})["genre_names"] == ["Old"]
+    assert backfill_lookup_names(db, batch_size=2) == 0
@@ -0,0 +1,73 @@
+import logging
+import threading
+from datetime import datetime
+
+from pymongo import MongoClient
+
+from utils.db_indexes import MIGRATIONS_COLLECTION
+from utils.game_names import backfill_lookup_names
+
+
+def null_missing_release_dates(db):
+    """Store a missing release_date as null instead of "".
+
+    Mongo compares $gt/$lt only within the same BSON type, so a keyset cursor
+    on release_date that reached the numeric dates would never reach the
+    string ones. Null sorts before every number and is handled by the cursor.
+    """
+    return db["games"].update_many({"release_date": ""}, {"$set": {"release_date": None}}).modified_count
+
+
+# Correzioni dei dati da eseguire una volta sola, in ordine; il nome è la chiave in migrations
+DATA_MIGRATIONS = {
+    "release_date_null": null_missing_release_dates,
+    # Nomi delle lookup denormalizzati sui giochi salvati prima dei campi *_names
+    "lookup_names": backfill_lookup_names,
+}
+
+
+def data_migration_id(name):
+    return f"data:{name}"
+
+
+def apply_data_migrations(db, migrations=DATA_MIGRATIONS):
+    """Run every data migration not yet recorded in the migrations collection.
+
+    A migration that raises is logged and retried at the next startup; the
+    following ones are not run. They can be slow on a large games collection,
+    so the API runs them from a background thread (see start_data_migrations). Returns the names of the applied migrations.
+    """
+    applied = []
+    for name, migration in migrations.items():
+        if db[MIGRATIONS_COLLECTION].find_one({"_id": data_migration_id(name)}):
+            continue
+        try:
+            result = migration(db)
+        except Exception as e:
+            logging.warning(f"Data migration {name} failed, it will be retried at next startup: {e}")
+            break
+        db[MIGRATIONS_COLLECTION].update_one(
+            {"_id": data_migration_id(name)},
+            {"$set": {"applied_at": datetime.now(), "result": result}},
+            upsert=True,
+        )
+        logging.info(f"Data migration {name} applied: {result}")
+        applied.append(name)
+    return applied
+
+
+def run_data_migrations(uri):
+    client = MongoClient(uri)
+    try:
+        apply_data_migrations(client["game_tracker"])
+    except Exception as e:
+        logging.error(f"Data migrations aborted, they will be retried at next startup: {e}")
+    finally:
+        client.close()
+
+
+def start_data_migrations(uri):
+    """Apply the pending data migrations in a daemon thread, without blocking the caller."""
+    thread = threading.Thread(target=run_data_migrations, args=(uri,), name="data-migrations", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,271 @@
+import logging
+from datetime import datetime
+
+from pymongo import ASCENDING, DESCENDING, TEXT
+from pymongo.errors import OperationFailure
+
+MIGRATIONS_COLLECTION = "migrations"
+INDEX_MIGRATION_ID = "indexes"
+# Codici di errore di create_index quando esiste già un indice con le stesse chiavi o lo stesso nome
+INDEX_CONFLICT_CODES = (85, 86)
+DUPLICATE_KEY_ERROR = 11000
+
+# Indici dichiarati per versione. Ogni voce indica le query che serve: una nuova
+# versione si aggiunge in coda, quelle già applicate non vengono rieseguite.
+INDEX_MIGRATIONS = {
+    1: [
+        {
+            "collection": "users",
+            "keys": [("username", ASCENDING)],
+            # username è facoltativo: l'unicità vale solo per quelli valorizzati
+            "options": {"unique": True, "partialFilterExpression": {"username": {"$type": "string"}}},
+            "serves": "get_user (every authenticated request), /users/token",
+        },
+        {
+            "collection": "platforms-users",
+            "keys": [("user_id", ASCENDING), ("platform", ASCENDING)],
+            "options": {"unique": True},
+            "dedupe": True,
+            "serves": "get_user platform lookups, /users/update, /platforms-users, /users/dashboard, sync_job linkage check and summary",
+        },
+        {
+            "collection": "game_user",
+            "keys": [("user_id", ASCENDING), ("platform", ASCENDING), ("game_id", ASCENDING)],
+            "options": {"unique": True},
+            "dedupe": True,
+            "serves": "/users/my-library, /users/my-library/remove, /games/add, /users/dashboard, sync_job game_user index and upserts",
+        },
+        {
+            "collection": "game_user",
+            "keys": [("game_id", ASCENDING)],
+            "options": {},
+            "serves": "/games/update-metadata game_user reassignment on merge",
+        },
+        {
+            "collection": "game_user_wishlist",
+            "keys": [("user_id", ASCENDING), ("game_id", ASCENDING)],
+            "options": {},
+            "serves": "/wishlist, /wishlist/add, /wishlist/remove, /users/dashboard wishlist count",
+        },
+        {
+            "collection": "schedules",
+            "keys": [("job_string_id", ASCENDING)],
+            # Non unico: i job_string_id storici avevano la risoluzione del secondo
+            "options": {},
+            "serves": "sync_job status updates and checkpoints",
+        },
+        {
+            "collection": "schedules",
+            "keys": [("job_id", ASCENDING)],
+            "options": {},
+            "serves": "/sync/status/{job_id}",
+        },
+        {
+            "collection": "schedules",
+            "keys": [("user_id", ASCENDING), ("updated_at", DESCENDING)],
+            "options": {},
+            "serves": "/sync_jobs sorted by updated_at, last sync job in /users/dashboard",
+        },
+        {
+            "collection": "games",
+            "keys": [("igdb_id", ASCENDING)],
+            "options": {"unique": True, "partialFilterExpression": {"igdb_id": {"$exists": True}}},
+            "serves": "/games/add, /games/update-metadata, /wishlist/add, /games/{igdb_id}/library-consoles and wishlist-consoles",
+        },
+        {
+            "collection": "games",
+            "keys": [("name", ASCENDING)],
+            "options": {},
+            "serves": "/games sorted by name",
+        },
+        {
+            "collection": "games",
+            "keys": [("normalized_name", ASCENDING)],
+            "options": {},
+            "serves": "game matching by normalized name, /games name search by title prefix",
+        },
+        {
+            "collection": "games",
+            "keys": [("psn_game_id", ASCENDING)],
+            "options": {},
+            "serves": "game matching by PSN product id",
+        },
+        {
+            "collection": "games",
+            "keys": [("steam_game_id", ASCENDING)],
+            "options": {},
+            "serves": "game matching by Steam appid",
+        },
+        {
+            "collection": "steam_schemas",
+            "keys": [("appid", ASCENDING)],
+            "options": {"unique": True},
+            "serves": "Steam achievement schema cache",
+        },
+        {
+            "collection": "steam_playtime",
+            "keys": [("user_id", ASCENDING), ("appid", ASCENDING)],
+            "options": {"unique": True},
+            "serves": "incremental Steam sync playtime state",
+        },
+        {
+            "collection": "psn_sync_state",
+            "keys": [("user_id", ASCENDING)],
+            "options": {"unique": True},
+            "serves": "incremental PSN sync watermarks",
+        },
+        {
+            "collection": "psn_titles",
+            "keys": [("title_id", ASCENDING)],
+            "options": {"unique": True},
+            "serves": "PSN title_id resolution cache",
+        },
+    ],
+    2: [
+        {
+            "collection": "games",
+            "keys": [("name", TEXT), ("original_name", TEXT)],
+            # Nessuna lingua: niente stemming né stop word sui titoli, spesso non in inglese
+            "options": {"weights": {"name": 10, "original_name": 5}, "default_language": "none"},
+            "serves": "/games name search by whole words, ranked by relevance",
+        },
+    ],
+    # Ordinamenti paginati: (campo, _id) come nel sort, così né skip né cursore richiedono
+    # un ordinamento in memoria; lo stesso indice serve anche l'ordine discendente
+    3: [
+        {
+            "collection": "games",
+            "keys": [("name", ASCENDING), ("_id", ASCENDING)],
+            "options": {},
+            "serves": "/games sorted by name, /users/my-library sorted by name",
+        },
+        {
+            "collection": "games",
+            "keys": [("release_date", ASCENDING), ("_id", ASCENDING)],
+            "options": {},
+            "serves": "/games sorted by release_date",
+        },
+        {
+            "collection": "games",
+            "keys": [("total_rating", ASCENDING), ("_id", ASCENDING)],
+            "options": {},
+            "serves": "/games sorted by total_rating",
+        },
+        {
+            "collection": "games",
+            "keys": [("total_rating_count", ASCENDING), ("_id", ASCENDING)],
+            "options": {},
+            "serves": "/games sorted by total_rating_count",
+        },
+        {
+            "collection": "schedules",
+            "keys": [("user_id", ASCENDING), ("updated_at", DESCENDING), ("_id", DESCENDING)],
+            "options": {},
+            "serves": "/sync_jobs pages and cursors sorted by updated_at",
+        },
+    ],
+}
+
+
+def index_name(keys):
+    # Stesso nome generato da create_index quando non se ne passa uno
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+
+def dedupe_unique_keys(collection, keys):
+    """Delete the documents sharing the same values for `keys`, keeping the latest
+    written one (highest _id), so that a unique index on `keys` can be built.
+
+    Returns the number of deleted documents.
+    """
+    group_id = {field.replace(".", "_"): f"${field}" for field, _ in keys}
+    duplicates = collection.aggregate(
+        [
+            {"$sort": {"_id": -1}},
+            {"$group": {"_id": group_id, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+        ],
+        allowDiskUse=True,
+    )
+    deleted = 0
+    for group in duplicates:
+        deleted += collection.delete_many({"_id": {"$in": group["ids"][1:]}}).deleted_count
+    return deleted
+
+
+def build_index(db, spec):
+    """Create the index declared by `spec` and return its name.
+
+    An index left with the same keys but older options is replaced, so that a
+    changed declaration is picked up; duplicates under a unique key are removed
+    first only when the spec allows it with `dedupe`.
+    """
+    collection = db[spec["collection"]]
+    # Dal 4.2 le build non bloccano più la collection; background resta per i server più vecchi
+    try:
+        return collection.create_index(spec["keys"], background=True, **spec["options"])
+    except OperationFailure as e:
+        if e.code == DUPLICATE_KEY_ERROR and spec.get("dedupe"):
+            deleted = dedupe_unique_keys(collection, spec["keys"])
+            logging.warning(f"Removed {deleted} duplicate documents from {spec['collection']} on {spec['keys']}")
+        elif e.code in INDEX_CONFLICT_CODES:
+            logging.warning(f"Replacing index {spec['collection']}.{index_name(spec['keys'])}: {e}")
+            collection.drop_index(index_name(spec["keys"]))
+        else:
+            raise
+    return collection.create_index(spec["keys"], background=True, **spec["options"])
+
+
+def apply_index_migrations(db, migrations=INDEX_MIGRATIONS):
+    """Build the declared indexes of every version newer than the recorded one.
+
+    create_index is a no-op for an index that already exists with the same
+    spec, so an interrupted version is simply rerun at the next startup. A
+    failing index (e.g. duplicates under a unique key) is reported and keeps
+    its version, and the following ones, from being recorded, but the other
+    indexes of every pending version are still built. Returns one report row
+    per index.
+    """
+    state = db[MIGRATIONS_COLLECTION].find_one({"_id": INDEX_MIGRATION_ID}) or {}
+    current_version = state.get("version", 0)
+    report = []
+    incomplete = False
+
+    for version in sorted(migrations):
+        if version <= current_version:
+            continue
+        failed = False
+        for spec in migrations[version]:
+            row = {
+                "version": version,
+                "collection": spec["collection"],
+                "keys": spec["keys"],
+                "serves": spec["serves"],
+            }
+            try:
+                row["name"] = build_index(db, spec)
+                row["status"] = "ok"
+            except OperationFailure as e:
+                row["status"] = f"failed: {e}"
+                failed = True
+            report.append(row)
+
+        if failed:
+            logging.warning(f"Index migration {version} incomplete, it will be retried at next startup")
+            incomplete = True
+        if incomplete:
+            # Le versioni successive sono comunque applicate, ma si registra solo fin dove tutto è riuscito
+            continue
+        db[MIGRATIONS_COLLECTION].update_one(
+            {"_id": INDEX_MIGRATION_ID},
+            {"$set": {"version": version, "applied_at": datetime.now(), "report": report}},
+            upsert=True,
+        )
+        current_version = version
+
+    for row in report:
+        logging.info(
+            f"Index {row['collection']}.{row.get('name', row['keys'])} [{row['status']}] serves: {row['serves']}"
+        )
+    logging.info(f"Index migrations at version {current_version}")
+    return report
@@ -0,0 +1,77 @@
+from pymongo import UpdateOne
+
+# Campo id del gioco -> (collection di lookup, campo nome, campo denormalizzato sul gioco)
+LOOKUP_NAME_FIELDS = {
+    "genres": ("genres", "genre_name", "genre_names"),
+    "platforms": ("console_platforms", "platform_name", "platform_names"),
+    "developer": ("companies", "company_name", "developer_names"),
+    "publisher": ("companies", "company_name", "publisher_names"),
+    "game_modes": ("game_modes", "game_mode_name", "game_mode_names"),
+}
+NAME_FIELDS = [names_field for _, _, names_field in LOOKUP_NAME_FIELDS.values()]
+BACKFILL_BATCH_SIZE = 500
+
+
+def lookup_ids(value):
+    # developer e publisher sono un singolo id, gli altri campi liste
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def add_lookup_names(db, game_docs):
+    """Set genre_names, platform_names, developer_names, publisher_names and
+    game_mode_names on the given game documents, with one query per lookup collection.
+    """
+    ids_by_collection = {}
+    for field, (collection, name_field, _) in LOOKUP_NAME_FIELDS.items():
+        ids = ids_by_collection.setdefault((collection, name_field), set())
+        for game_doc in game_docs:
+            ids.update(lookup_ids(game_doc.get(field)))
+
+    names = {}
+    for (collection, name_field), ids in ids_by_collection.items():
+        names[collection] = {}
+        if ids:
+            for doc in db[collection].find({"igdb_id": {"$in": list(ids)}}, {"igdb_id": 1, name_field: 1}):
+                if doc.get(name_field) is not None:
+                    names[collection][doc["igdb_id"]] = doc[name_field]
+
+    for game_doc in game_docs:
+        for field, (collection, _, names_field) in LOOKUP_NAME_FIELDS.items():
+            game_doc[names_field] = [
+                names[collection][igdb_id]
+                for igdb_id in lookup_ids(game_doc.get(field))
+                if igdb_id in names[collection]
+            ]
+    return game_docs
+
+
+def backfill_lookup_names(db, batch_size=BACKFILL_BATCH_SIZE):
+    """Denormalize the lookup names on games written before the *_names fields existed.
+
+    Games are walked in _id order and only documents without genre_names are
+    touched, so every document is read at most once. Returns the number of
+    updated games.
+    """
+    projection = {field: 1 for field in LOOKUP_NAME_FIELDS}
+    updated = 0
+    last_id = None
+    while True:
+        # Avanza per intervalli di _id: ogni blocco riparte dall'indice dove è finito il precedente
+        query = {"genre_names": {"$exists": False}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = list(db["games"].find(query, projection).sort("_id", 1).limit(batch_size))
+        if not batch:
+            return updated
+        last_id = batch[-1]["_id"]
+        add_lookup_names(db, batch)
+        db["games"].bulk_write(
+            [
+                UpdateOne({"_id": game["_id"]}, {"$set": {field: game[field] for field in NAME_FIELDS}})
+                for game in batch
+            ],
+            ordered=False,
+        )
+        updated += len(batch)
@@ -0,0 +1,64 @@
+import re
+import string
+
+# Bonus di rilevanza per i giochi il cui nome normalizzato inizia con la ricerca,
+# così il completamento di un titolo precede le corrispondenze parola per parola
+PREFIX_MATCH_BOOST = 100
+
+
+def normalize_name(name):
+    if not name:
+        return ""
+    name = name.translate(str.maketrans("", "", string.punctuation))
+    return " ".join(name.lower().split())
+
+
+def name_search_filter(name):
+    """Indexed filter for the /games name search, or None when nothing is left to search.
+
+    Whole words go through the text index on name/original_name; the prefix of
+    normalized_name (also indexed) covers the word still being typed. $text
+    matches any one of the words, so every word must also be found on its own:
+    the last one as the start of a word, since it may not be complete yet.
+    """
+    normalized = normalize_name(name)
+    if not normalized:
+        return None
+    words = normalized.split()
+    word_patterns = [rf"\b{re.escape(word)}\b" for word in words[:-1]] + [rf"\b{re.escape(words[-1])}"]
+    return {
+        "$or": [
+            {"$text": {"$search": normalized}},
+            {"normalized_name": {"$regex": f"^{re.escape(normalized)}"}},
+        ],
+        "$and": [
+            {
+                "$or": [
+                    {"normalized_name": {"$regex": pattern}},
+                    {"original_name": {"$regex": pattern, "$options": "i"}},
+                ]
+            }
+            for pattern in word_patterns
+        ],
+    }
+
+
+def relevance_stage(name):
+    """$addFields computing `relevance` for documents matched by name_search_filter."""
+    normalized = normalize_name(name)
+    return {
+        "$addFields": {
+            "relevance": {
+                "$add": [
+                    {"$meta": "textScore"},
+                    {
+                        "$cond": [
+                            {"$eq": [{"$indexOfCP": [{"$ifNull": ["$normalized_name", ""]}, normalized]}, 0]},
+                            PREFIX_MATCH_BOOST,
+                            0,
+                        ]
+                    },
+                ]
+            }
+        }
+    }
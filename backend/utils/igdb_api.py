@@ -1,5 +1,9 @@
+import asyncio
+import threading
 import time
 import requests
+import httpx
+from redis.exceptions import RedisError
 from igdb.wrapper import IGDBWrapper
 import json
 import pycountry
@@ -14,13 +18,145 @@ def country_name_from_numeric_code(numeric_code):
     return country.name if country else None
 
 
+GAME_METADATA_FIELDS = '''
+    fields 
+    name,
+    summary,
+    storyline,
+    genres.name,
+    themes.name,
+    keywords.name,
+    platforms.name,
+    release_dates.date,
+    release_dates.human,
+    release_dates.platform.name,
+    first_release_date,
+    involved_companies.company.name,
+    involved_companies.developer,
+    involved_companies.publisher,
+    involved_companies.porting,
+    involved_companies.supporting,
+    cover.url,
+    artworks.url,
+    screenshots.url,
+    videos.video_id,
+    websites.url,
+    websites.category,
+    game_modes.name,
+    player_perspectives.name,
+    category,
+    status,
+    total_rating,
+    total_rating_count,
+    aggregated_rating,
+    aggregated_rating_count,
+    collection.name,
+    franchise.name,
+    similar_games.name;
+    '''
+
+
+def format_game_metadata(game):
+    if "artworks" in game:
+        game["artworks"] = [artwork["url"] for artwork in game["artworks"]]
+
+    if "game_modes" in game:
+        game["game_modes"] = [mode["id"] for mode in game["game_modes"]]
+
+    if "genres" in game:
+        game["genres"] = [genre["id"] for genre in game["genres"]]
+
+    if "involved_companies" in game:
+        game["developer"] = next(
+            (company["company"]["id"] for company in game["involved_companies"] if company.get("developer")), "")
+        game["publisher"] = next(
+            (company["company"]["id"] for company in game["involved_companies"] if company.get("publisher")), "")
+
+    if "platforms" in game:
+        game["platforms"] = [platform["id"] for platform in game["platforms"]]
+
+    if "screenshots" in game:
+        game["screenshots"] = [screenshot["url"] for screenshot in game["screenshots"]]
+
+    return {
+        "igdb_id": game.get("id"),
+        "name": game.get("name"),
+        "platforms": game.get("platforms", []),
+        "genres": game.get("genres", []),
+        "game_modes": game.get("game_modes", []),
+        # Null e non "": un tipo diverso dai timestamp bloccherebbe i cursori su release_date
+        "release_date": game.get("first_release_date"),
+        "publisher": game.get("publisher", ""),
+        "developer": game.get("developer", ""),
+        "description": game.get("summary", ""),
+        "cover_image": game.get("cover", {}).get("url", ""),
+        "screenshots": game.get("screenshots", []),
+        "artworks": game.get("artworks", []),
+        "total_rating": game.get("total_rating", 0.0),
+        "total_rating_count": game.get("total_rating_count", 0),
+    }
+
+
+# Token Twitch condiviso tra API e worker
+# La quota IGDB (4 richieste al secondo) è divisa tra i worker di sync e l'API: ognuno
+# dei due gruppi ha un token bucket su Redis condiviso da tutti i suoi processi
+IGDB_SYNC_RATE_LIMIT_KEY = "igdb:rate_limit:sync"
+IGDB_API_RATE_LIMIT_KEY = "igdb:rate_limit:api"
+
+TOKEN_CACHE_KEY = "igdb:access_token"
+TOKEN_LOCK_KEY = "igdb:access_token:lock"
+TOKEN_LOCK_TIMEOUT = 30
+
+
+def load_shared_token(redis_client):
+    """Return (access_token, token_expiry) stored in Redis, or None if missing or expired."""
+    try:
+        data = redis_client.hgetall(TOKEN_CACHE_KEY)
+    except RedisError as e:
+        logger.warning(f"Could not read shared IGDB token: {e}")
+        return None
+    access_token = data.get(b"access_token")
+    token_expiry = int(data.get(b"expires_at", 0))
+    if not access_token or time.time() >= token_expiry:
+        return None
+    return access_token.decode(), token_expiry
+
+
+def store_shared_token(redis_client, access_token, token_expiry):
+    try:
+        pipe = redis_client.pipeline()
+        pipe.hset(
+            TOKEN_CACHE_KEY,
+            mapping={"access_token": access_token, "expires_at": token_expiry},
+        )
+        pipe.expireat(TOKEN_CACHE_KEY, token_expiry)
+        pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Could not store shared IGDB token: {e}")
+
+
 class IGDBAutoAuthClient:
-    def __init__(self, client_id: str, client_secret: str):
+    def __init__(self, client_id: str, client_secret: str, rate_limiter=None, cache=None, redis_client=None):
         self.client_id = client_id
         self.client_secret = client_secret
         self.access_token = None
         self.token_expiry = 0  # Unix timestamp
         self.wrapper = None
+        # Optional TokenBucket shared by every thread issuing queries through this client
+        self.rate_limiter = rate_limiter
+        # Optional IGDBResponseCache consulted before every query
+        self.cache = cache
+        # Optional Redis client used to share one access token across processes
+        self.redis = redis_client
+        self._token_lock = threading.Lock()
+
+    def _set_access_token(self, access_token: str, token_expiry: int):
+        self.access_token = access_token
+        self.token_expiry = token_expiry
+        self.wrapper = IGDBWrapper(self.client_id, self.access_token)
+
+    def _token_is_valid(self):
+        return self.access_token is not None and time.time() < self.token_expiry
 
     def _fetch_access_token(self):
         response = requests.post(
@@ -33,21 +169,59 @@ class IGDBAutoAuthClient:
         )
         response.raise_for_status()
         data = response.json()
-        self.access_token = data["access_token"]
         expires_in = data.get("expires_in", 3600)
-        self.token_expiry = int(time.time()) + expires_in - 60  # buffer before expiry
-        self.wrapper = IGDBWrapper(self.client_id, self.access_token)
+        self._set_access_token(
+            data["access_token"],
+            int(time.time()) + expires_in - 60,  # buffer before expiry
+        )
+
+    def _load_shared_token(self):
+        shared_token = load_shared_token(self.redis)
+        if shared_token is None:
+            return False
+        self._set_access_token(*shared_token)
+        return True
+
+    def _store_shared_token(self):
+        store_shared_token(self.redis, self.access_token, self.token_expiry)
 
     def _ensure_token_valid(self):
-        if not self.access_token or time.time() >= self.token_expiry:
-            self._fetch_access_token()
+        if self._token_is_valid():
+            return
+        with self._token_lock:
+            if self._token_is_valid():
+                return
+            if self.redis is None:
+                self._fetch_access_token()
+                return
+            if self._load_shared_token():
+                return
+            # Un solo processo rinnova il token, gli altri lo rileggono da Redis
+            try:
+                with self.redis.lock(TOKEN_LOCK_KEY, timeout=TOKEN_LOCK_TIMEOUT, blocking_timeout=TOKEN_LOCK_TIMEOUT):
+                    if self._load_shared_token():
+                        return
+                    self._fetch_access_token()
+                    self._store_shared_token()
+            except RedisError as e:
+                logger.warning(f"Shared IGDB token lock unavailable, refreshing locally: {e}")
+                if not self._token_is_valid():
+                    self._fetch_access_token()
 
     def query(self, endpoint: str, query: str):
+        if self.cache is not None:
+            cached = self.cache.get(endpoint, query)
+            if cached is not None:
+                return cached
         self._ensure_token_valid()
-        return self.wrapper.api_request(endpoint, query)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        result = self.wrapper.api_request(endpoint, query)
+        if self.cache is not None:
+            self.cache.set(endpoint, query, result)
+        return result
     
     def query_games(self, query: str):
-        self._ensure_token_valid()
         return self.query("games", query)
     
     def get_game_metadata(self, game_name: str, external_id: str = None, igdb_id: int = None):
@@ -72,42 +246,7 @@ class IGDBAutoAuthClient:
         else:
             game_id = None
         
-        query = '''
-        fields 
-        name,
-        summary,
-        storyline,
-        genres.name,
-        themes.name,
-        keywords.name,
-        platforms.name,
-        release_dates.date,
-        release_dates.human,
-        release_dates.platform.name,
-        first_release_date,
-        involved_companies.company.name,
-        involved_companies.developer,
-        involved_companies.publisher,
-        involved_companies.porting,
-        involved_companies.supporting,
-        cover.url,
-        artworks.url,
-        screenshots.url,
-        videos.video_id,
-        websites.url,
-        websites.category,
-        game_modes.name,
-        player_perspectives.name,
-        category,
-        status,
-        total_rating,
-        total_rating_count,
-        aggregated_rating,
-        aggregated_rating_count,
-        collection.name,
-        franchise.name,
-        similar_games.name;
-        '''
+        query = GAME_METADATA_FIELDS
 
         if game_id:
             query += f'where id = {game_id};'
@@ -124,50 +263,10 @@ class IGDBAutoAuthClient:
         result = json.loads(result)
         
         try:
-            if "artworks" in result[0]:
-                result[0]["artworks"] = [artwork["url"] for artwork in result[0]["artworks"]]
-                
-            if "game_modes" in result[0]:
-                result[0]["game_modes"] = [mode["id"] for mode in result[0]["game_modes"]]
-                
-            if "genres" in result[0]:
-                result[0]["genres"] = [genre["id"] for genre in result[0]["genres"]]
-            
-            if "involved_companies" in result[0]:
-                result[0]["developer"] = next(
-                    (company["company"]["id"] for company in result[0]["involved_companies"] if company.get("developer")), "")
-                result[0]["publisher"] = next(
-                    (company["company"]["id"] for company in result[0]["involved_companies"] if company.get("publisher")), "")
-                
-            if "platforms" in result[0]:
-                result[0]["platforms"] = [platform["id"] for platform in result[0]["platforms"]]
-                
-            if "screenshots" in result[0]:
-                result[0]["screenshots"] = [screenshot["url"] for screenshot in result[0]["screenshots"]]
-                
+            return format_game_metadata(result[0])
         except IndexError as e:
             logger.error(f"IndexError: {e} - Result: {result}")
             return None
-          
-        
-        game_metadata = {
-            "igdb_id": result[0].get("id"),
-            "name": result[0].get("name"),
-            "platforms": result[0].get("platforms", []),
-            "genres": result[0].get("genres", []),
-            "game_modes": result[0].get("game_modes", []),
-            "release_date": result[0].get("first_release_date", ""),
-            "publisher": result[0].get("publisher", ""),
-            "developer": result[0].get("developer", ""),
-            "description": result[0].get("summary", ""),
-            "cover_image": result[0].get("cover", {}).get("url", ""),
-            "screenshots": result[0].get("screenshots", []),
-            "artworks": result[0].get("artworks", []),
-            "total_rating": result[0].get("total_rating", 0.0),
-            "total_rating_count": result[0].get("total_rating_count", 0),
-        }
-        
-        return game_metadata
     
     def get_all_game_genres(self):
         offset = 0
@@ -265,3 +364,205 @@ class IGDBAutoAuthClient:
                 companies.append(comp)
             offset += 500
         return companies
+
+
+IGDB_API_URL = "https://api.igdb.com/v4"
+TWITCH_TOKEN_URL = "https://id.twitch.tv/oauth2/token"
+IGDB_MAX_CONNECTIONS = 8
+
+
+class AsyncIGDBClient:
+    """Async counterpart of IGDBAutoAuthClient on a keep-alive httpx connection pool.
+
+    Exposes the same query / get_game_metadata / get_all_* surface as coroutines and
+    shares the response cache and the Redis-held access token with the sync client.
+    """
+
+    def __init__(self, client_id: str, client_secret: str, rate_limiter=None, cache=None, redis_client=None, max_connections: int = IGDB_MAX_CONNECTIONS):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.access_token = None
+        self.token_expiry = 0  # Unix timestamp
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.redis = redis_client
+        self.http = httpx.AsyncClient(
+            base_url=IGDB_API_URL,
+            timeout=httpx.Timeout(30.0),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+        self._token_lock = asyncio.Lock()
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    def _token_is_valid(self):
+        return self.access_token is not None and time.time() < self.token_expiry
+
+    async def _fetch_access_token(self):
+        response = await self.http.post(
+            TWITCH_TOKEN_URL,
+            data={
+                "client_id": self.client_id,
+                "client_secret": self.client_secret,
+                "grant_type": "client_credentials",
+            },
+        )
+        response.raise_for_status()
+        data = response.json()
+        expires_in = data.get("expires_in", 3600)
+        self.access_token = data["access_token"]
+        self.token_expiry = int(time.time()) + expires_in - 60  # buffer before expiry
+
+    async def _load_shared_token(self):
+        shared_token = await asyncio.to_thread(load_shared_token, self.redis)
+        if shared_token is None:
+            return False
+        self.access_token, self.token_expiry = shared_token
+        return True
+
+    async def _ensure_token_valid(self):
+        if self._token_is_valid():
+            return
+        async with self._token_lock:
+            if self._token_is_valid():
+                return
+            if self.redis is None:
+                await self._fetch_access_token()
+                return
+            if await self._load_shared_token():
+                return
+            # acquire e release girano in due to_thread, quindi su thread diversi:
+            # il token del lock non può stare in un thread-local
+            lock = self.redis.lock(
+                TOKEN_LOCK_KEY, timeout=TOKEN_LOCK_TIMEOUT, blocking_timeout=TOKEN_LOCK_TIMEOUT, thread_local=False
+            )
+            try:
+                acquired = await asyncio.to_thread(lock.acquire)
+            except RedisError as e:
+                logger.warning(f"Shared IGDB token lock unavailable, refreshing locally: {e}")
+                acquired = False
+            if not acquired:
+                await self._fetch_access_token()
+                return
+            try:
+                if await self._load_shared_token():
+                    return
+                await self._fetch_access_token()
+                await asyncio.to_thread(store_shared_token, self.redis, self.access_token, self.token_expiry)
+            finally:
+                try:
+                    await asyncio.to_thread(lock.release)
+                except RedisError as e:
+                    logger.warning(f"Could not release shared IGDB token lock: {e}")
+
+    async def query(self, endpoint: str, query: str):
+        if self.cache is not None:
+            cached = await asyncio.to_thread(self.cache.get, endpoint, query)
+            if cached is not None:
+                return cached
+        await self._ensure_token_valid()
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire_async()
+        response = await self.http.post(
+            f"/{endpoint}",
+            content=query,
+            headers={
+                "Client-ID": self.client_id,
+                "Authorization": f"Bearer {self.access_token}",
+            },
+        )
+        response.raise_for_status()
+        result = response.content
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.set, endpoint, query, result)
+        return result
+
+    async def query_games(self, query: str):
+        return await self.query("games", query)
+
+    async def get_game_metadata(self, game_name: str, external_id: str = None, igdb_id: int = None):
+        game_id = None
+        if igdb_id is not None:
+            game_id = igdb_id
+        elif external_id is not None:
+            external_game_query = f'''
+            fields id, game, name, uid, category;
+            where uid="{external_id}" & category = (1,36);
+            '''
+            external_game_result = json.loads(await self.query("external_games", external_game_query))
+            logger.info(f"External Game Result: {external_game_result}")
+            game_id = external_game_result[0].get("game", None) if external_game_result else None
+
+        query = GAME_METADATA_FIELDS
+        if game_id:
+            query += f'where id = {game_id};'
+        else:
+            query += f'''
+            where name ~ *"{game_name}"* & category = 0;
+            limit 1;
+            '''
+        result = json.loads(await self.query_games(query))
+        if not result:
+            logger.info(f"No game found for name: {game_name} with external ID: {external_id}")
+            return None
+        return format_game_metadata(result[0])
+
+    async def _query_all(self, endpoint: str, fields: str):
+        offset = 0
+        items = []
+        while True:
+            query = f'''
+            fields {fields};
+            limit 500;
+            offset {offset};
+            '''
+            result = json.loads(await self.query(endpoint, query))
+            if not result:
+                break
+            items.extend(result)
+            offset += 500
+        return items
+
+    async def get_all_game_genres(self):
+        return [
+            {"igdb_id": genre["id"], "genre_name": genre["name"]}
+            for genre in await self._query_all("genres", "id, name")
+        ]
+
+    async def get_all_game_platforms(self):
+        return [
+            {
+                "igdb_id": platform["id"],
+                "platform_name": platform["name"],
+                "abbreviation": platform.get("abbreviation", ""),
+                "generation": platform.get("generation", 0),
+            }
+            for platform in await self._query_all("platforms", "id, name, abbreviation, generation")
+        ]
+
+    async def get_all_game_modes(self):
+        return [
+            {"igdb_id": mode["id"], "game_mode_name": mode["name"]}
+            for mode in await self._query_all("game_modes", "id, name")
+        ]
+
+    async def get_all_game_companies(self):
+        companies = []
+        for company in await self._query_all("companies", "id, name, description, country, logo.url"):
+            if "duplicate" in company["name"].lower():
+                logger.warning(f"Skipping duplicate company: {company['name']}")
+                continue
+            companies.append(
+                {
+                    "igdb_id": company["id"],
+                    "company_name": company["name"],
+                    "country": country_name_from_numeric_code(company.get("country", 0)),
+                    "description": company.get("description", ""),
+                    "logo_url": company.get("logo", {}).get("url", ""),
+                }
+            )
+        return companies
@@ -0,0 +1,173 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# TTL (secondi) delle risposte IGDB per endpoint
+IGDB_CACHE_TTLS = {
+    "games": 24 * 3600,
+    "external_games": 7 * 24 * 3600,
+    "genres": 30 * 24 * 3600,
+    "platforms": 30 * 24 * 3600,
+    "game_modes": 30 * 24 * 3600,
+    "companies": 7 * 24 * 3600,
+}
+DEFAULT_CACHE_TTL = 3600
+# Le ricerche senza risultati scadono prima, i giochi appena usciti compaiono presto
+EMPTY_RESULT_TTL = 3600
+LOCAL_CACHE_SIZE = 1024
+CACHE_KEY_PREFIX = "igdb:cache"
+CACHE_STATS_KEY = "igdb:cache:stats"
+# I contatori condivisi si accumulano in memoria e vanno su Redis al massimo ogni
+# STATS_FLUSH_INTERVAL secondi o ogni STATS_FLUSH_BATCH eventi, mai a ogni get
+STATS_FLUSH_INTERVAL = 30
+STATS_FLUSH_BATCH = 500
+
+
+class IGDBResponseCache:
+    """Two-level cache for raw IGDB responses: in-process LRU in front of Redis.
+
+    Entries are keyed on (endpoint, whitespace-normalized query) and expire after
+    a per-endpoint TTL. Redis errors are logged and the cache degrades to the
+    local LRU only. Hit/miss counters are kept in process and added to the
+    shared Redis hash in batches by `flush_stats`.
+    """
+
+    def __init__(self, redis_client=None, max_local_entries=LOCAL_CACHE_SIZE, ttls=None):
+        self.redis = redis_client
+        self.max_local_entries = max_local_entries
+        self.ttls = {**IGDB_CACHE_TTLS, **(ttls or {})}
+        self._local = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self._pending_counts = Counter()
+        self._last_stats_flush = time.monotonic()
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        return " ".join(query.split())
+
+    def make_key(self, endpoint: str, query: str) -> str:
+        digest = hashlib.sha1(self.normalize_query(query).encode("utf-8")).hexdigest()
+        return f"{CACHE_KEY_PREFIX}:{endpoint}:{digest}"
+
+    def ttl_for(self, endpoint: str, value) -> int:
+        ttl = self.ttls.get(endpoint, DEFAULT_CACHE_TTL)
+        if value in (b"[]", "[]"):
+            ttl = min(ttl, EMPTY_RESULT_TTL)
+        return ttl
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._local[key]
+                return None
+            self._local.move_to_end(key)
+            return value
+
+    def _set_local(self, key, value, ttl):
+        with self._lock:
+            self._local[key] = (time.time() + ttl, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_local_entries:
+                self._local.popitem(last=False)
+
+    def _count(self, endpoint, outcome):
+        if self.redis is None:
+            return
+        with self._lock:
+            self._pending_counts[f"{endpoint}:{outcome}"] += 1
+            due = (
+                sum(self._pending_counts.values()) >= STATS_FLUSH_BATCH
+                or time.monotonic() - self._last_stats_flush >= STATS_FLUSH_INTERVAL
+            )
+        if due:
+            self.flush_stats()
+
+    def flush_stats(self):
+        """Add the counters accumulated since the last flush to the shared Redis hash"""
+        if self.redis is None:
+            return
+        with self._lock:
+            counts, self._pending_counts = self._pending_counts, Counter()
+            self._last_stats_flush = time.monotonic()
+        if not counts:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for field, amount in counts.items():
+                pipe.hincrby(CACHE_STATS_KEY, field, amount)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"IGDB cache stats update failed: {e}")
+            # Riprovati al prossimo flush invece di andare persi
+            with self._lock:
+                self._pending_counts.update(counts)
+
+    def get(self, endpoint: str, query: str):
+        key = self.make_key(endpoint, query)
+        value = self._get_local(key)
+        if value is not None:
+            self.local_hits += 1
+            self._count(endpoint, "hits")
+            return value
+
+        if self.redis is not None:
+            try:
+                pipe = self.redis.pipeline()
+                pipe.get(key)
+                pipe.ttl(key)
+                value, ttl = pipe.execute()
+            except Exception as e:
+                logger.warning(f"IGDB cache read failed for {endpoint}: {e}")
+                value, ttl = None, None
+            if value is not None:
+                # Mai oltre la scadenza residua in Redis
+                self._set_local(key, value, ttl if ttl and ttl > 0 else self.ttl_for(endpoint, value))
+                self.redis_hits += 1
+                self._count(endpoint, "hits")
+                return value
+
+        self.misses += 1
+        self._count(endpoint, "misses")
+        return None
+
+    def set(self, endpoint: str, query: str, value):
+        if value is None:
+            return
+        key = self.make_key(endpoint, query)
+        ttl = self.ttl_for(endpoint, value)
+        self._set_local(key, value, ttl)
+        if self.redis is not None:
+            try:
+                self.redis.set(key, value, ex=ttl)
+            except Exception as e:
+                logger.warning(f"IGDB cache write failed for {endpoint}: {e}")
+
+    def stats(self) -> dict:
+        stats = {
+            "local_hits": self.local_hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "local_entries": len(self._local),
+        }
+        if self.redis is not None:
+            self.flush_stats()
+            try:
+                shared = self.redis.hgetall(CACHE_STATS_KEY)
+                stats["shared"] = {
+                    (k.decode() if isinstance(k, bytes) else k): int(v)
+                    for k, v in shared.items()
+                }
+            except Exception as e:
+                logger.warning(f"IGDB cache stats read failed: {e}")
+        return stats
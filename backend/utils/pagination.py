@@ -0,0 +1,73 @@
+import base64
+import binascii
+
+from bson import json_util
+from fastapi import HTTPException, status
+
+
+# Paginazione keyset: il cursore è l'ultima chiave di ordinamento restituita (campo + _id),
+# quindi la pagina successiva è una range query sull'indice invece di uno skip lineare.
+
+
+def encode_cursor(sort, doc):
+    """Opaque cursor pointing right after `doc` for the given [(field, direction), ...] sort."""
+    payload = {
+        "sort": [[field, direction] for field, direction in sort],
+        "values": [doc.get(field) for field, _ in sort],
+    }
+    return base64.urlsafe_b64encode(json_util.dumps(payload).encode()).decode()
+
+
+def decode_cursor(cursor, sort):
+    """Return the sort key values stored in `cursor`, rejecting cursors built for another sort."""
+    try:
+        payload = json_util.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        payload = None
+    if (
+        not isinstance(payload, dict)
+        or payload.get("sort") != [[field, direction] for field, direction in sort]
+        or len(payload.get("values", [])) != len(sort)
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor for the requested sort",
+        )
+    return payload["values"]
+
+
+def _after(direction, value):
+    # Mongo ordina null/mancante prima di ogni altro valore: in ordine discendente
+    # i null vengono dopo, e $gt/$lt non li confrontano mai con un valore non nullo
+    if value is None:
+        return [{"$ne": None}] if direction == 1 else []
+    conditions = [{"$gt" if direction == 1 else "$lt": value}]
+    if direction == -1:
+        conditions.append(None)
+    return conditions
+
+
+def keyset_filter(sort, values):
+    """Match the documents that come strictly after `values` in the given sort."""
+    branches = []
+    for i, ((field, direction), value) in enumerate(zip(sort, values)):
+        prefix = {prev_field: prev_value for (prev_field, _), prev_value in zip(sort[:i], values[:i])}
+        for condition in _after(direction, value):
+            branches.append({**prefix, field: condition})
+    return {"$or": branches} if branches else {"_id": {"$exists": False}}
+
+
+def find_page(collection, query, sort, limit, cursor=None, skip=0):
+    """Fetch one page of `collection` ordered by `sort`, which must end with _id.
+
+    With a cursor the page starts right after it and `skip` is ignored.
+    Returns the documents and the cursor of the next page (None on the last one).
+    """
+    if cursor:
+        query = {"$and": [query, keyset_filter(sort, decode_cursor(cursor, sort))]}
+        skip = 0
+    docs = list(collection.find(query).sort(sort).skip(skip).limit(limit + 1))
+    if len(docs) <= limit:
+        return docs, None
+    docs = docs[:limit]
+    return docs, encode_cursor(sort, docs[-1])
@@ -0,0 +1,35 @@
+import logging
+import threading
+
+import pytest
+
+pytest.importorskip("psnawp_api")
+
+from sync_worker.utils.psnTrack import UNRESOLVED_TITLE, PsnTitleResolver
+
+
+def test_stuck_threads_are_counted_across_batches():
+    release = threading.Event()
+
+    def resolve(title_id):
+        if title_id.startswith("stuck"):
+            release.wait()
+        return {"np_communication_id": f"NP_{title_id}", "product_id": None}
+
+    resolver = PsnTitleResolver(resolve, logging.getLogger(), max_workers=2, requests_per_second=100, timeout=0.5)
+    try:
+        first = resolver.resolve_titles(["stuck1", "a"])
+        assert first == {"stuck1": UNRESOLVED_TITLE, "a": {"np_communication_id": "NP_a", "product_id": None}}
+
+        resolver.resolve_titles(["stuck2"])
+        # Entrambi i thread del pool sono bloccati: il blocco successivo non ne apre altri
+        assert resolver.resolve_titles(["b"]) == {"b": UNRESOLVED_TITLE}
+        assert sum(thread.name.startswith("psn-resolve") for thread in threading.enumerate()) == 2
+
+        release.set()
+        for future in list(resolver.timed_out):
+            future.result(timeout=5)
+        assert resolver.resolve_titles(["c"]) == {"c": {"np_communication_id": "NP_c", "product_id": None}}
+    finally:
+        release.set()
+        resolver.close()
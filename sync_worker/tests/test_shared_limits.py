@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+mongomock = pytest.importorskip("mongomock")
+pytest.importorskip("arq")
+pytest.importorskip("psnawp_api")
+
+from arq.connections import ArqRedis
+from fakeredis.aioredis import FakeAsyncRedisConnection
+from redis.asyncio import ConnectionPool
+
+from sync_worker import worker_sync
+from sync_worker.utils.rate_limit import RedisTokenBucket
+
+
+def test_redis_bucket_is_shared_between_processes():
+    redis_client = fakeredis.FakeRedis()
+    # Due bucket sulla stessa chiave, come due processi worker
+    first = RedisTokenBucket(redis_client, "igdb:rate_limit:sync", 2)
+    second = RedisTokenBucket(redis_client, "igdb:rate_limit:sync", 2)
+
+    delays = [first._reserve(), second._reserve(), first._reserve(), second._reserve()]
+
+    assert delays[:2] == [0.0, 0.0]
+    assert 0.4 < delays[2] <= 0.5
+    assert 0.9 < delays[3] <= 1.0
+
+
+def test_legacy_queue_jobs_are_moved_to_platform_queues():
+    async def run():
+        server = fakeredis.FakeServer()
+        redis = ArqRedis(connection_pool=ConnectionPool(connection_class=FakeAsyncRedisConnection, server=server))
+        db = mongomock.MongoClient()["game_tracker"]
+        db["schedules"].insert_one({"job_string_id": "job-3", "status": "queued"})
+        await redis.enqueue_job("sync_job", "user", "steam", "job-1", _job_id="job-1")
+        await redis.enqueue_job("sync_job", "user", "psn", "job-2", _job_id="job-2")
+        await redis.enqueue_job("sync_job", "user", "xbox", "job-3", _job_id="job-3")
+
+        await worker_sync.redirect_legacy_jobs(redis, db)
+
+        assert await redis.zrange(worker_sync.LEGACY_SYNC_QUEUE, 0, -1) == []
+        assert await redis.zrange(worker_sync.STEAM_SYNC_QUEUE, 0, -1) == [b"job-1"]
+        assert await redis.zrange(worker_sync.PSN_SYNC_QUEUE, 0, -1) == [b"job-2"]
+        assert db["schedules"].find_one({"job_string_id": "job-3"})["status"] == "fail"
+
+    asyncio.run(run())
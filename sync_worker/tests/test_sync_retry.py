@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+pytest.importorskip("arq")
+pytest.importorskip("psnawp_api")
+pymongo = pytest.importorskip("pymongo")
+if pymongo.version_tuple >= (4, 9):
+    # UpdateOne passa `sort` al bulk builder, che mongomock non conosce ancora
+    pytest.skip("mongomock cannot run bulk writes with pymongo >= 4.9", allow_module_level=True)
+
+from arq.worker import Retry
+
+from sync_worker import worker_sync
+from sync_worker.utils.records import PlatformGameRecord
+
+
+class FakeIGDBClient:
+    """Resolves every title by name and counts the lookups."""
+
+    def __init__(self):
+        self.lookups = []
+
+    async def get_games_metadata_bulk(self, external_ids):
+        return {}
+
+    async def get_game_metadata(self, game_name, external_id=None):
+        self.lookups.append(game_name)
+        appid = int(game_name.split()[-1])
+        return {"name": game_name, "igdb_id": 1000 + appid, "platforms": [6]}
+
+
+def fake_sync_steam(games, orders=None):
+    """Steam tracker stub; `orders` gives the appid order returned by each call."""
+    orders = iter(orders or [])
+
+    def sync_steam(api_key, steam_id, **kwargs):
+        appids = next(orders, range(1, games + 1))
+        records = (
+            PlatformGameRecord(title_id=appid, name=f"Game {appid}", play_count=10)
+            for appid in appids
+        )
+        return {"fullGames": records, "gameCount": games}
+    return sync_steam
+
+
+@pytest.fixture
+def sync_env(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "logs").mkdir()
+    db = mongomock.MongoClient()["game_tracker"]
+    user_id = db["users"].insert_one({"username": "player"}).inserted_id
+    db["platforms-users"].insert_one(
+        {"user_id": str(user_id), "platform": "steam", "platform_id": "7656", "api_key": "key"}
+    )
+    db["schedules"].insert_one(
+        {"job_string_id": "job-1", "user_id": str(user_id), "platform": "steam", "status": "queued"}
+    )
+    return db, str(user_id)
+
+
+def test_sync_resumes_from_checkpoint_across_retries(sync_env, monkeypatch):
+    db, user_id = sync_env
+    igdb_client = FakeIGDBClient()
+    monkeypatch.setattr(worker_sync, "sync_steam", fake_sync_steam(5))
+    monkeypatch.setattr(worker_sync, "SYNC_CHUNK_SIZE", 2)
+    # Scadenza già raggiunta: ogni tentativo scrive un solo blocco e chiede un retry
+    monkeypatch.setattr(worker_sync, "SYNC_DEADLINE_MARGIN", worker_sync.SYNC_JOB_TIMEOUT)
+
+    checkpoints = []
+    for job_try in (1, 2):
+        ctx = {"db": db, "igdb_client": igdb_client, "job_try": job_try}
+        with pytest.raises(Retry):
+            asyncio.run(worker_sync.sync_job(ctx, user_id, "steam", "job-1"))
+        schedule = db["schedules"].find_one({"job_string_id": "job-1"})
+        assert schedule["status"] == "queued"
+        checkpoints.append(schedule["checkpoint"]["processed"])
+    assert checkpoints == [2, 4]
+
+    ctx = {"db": db, "igdb_client": igdb_client, "job_try": 3}
+    asyncio.run(worker_sync.sync_job(ctx, user_id, "steam", "job-1"))
+
+    schedule = db["schedules"].find_one({"job_string_id": "job-1"})
+    assert schedule["status"] == "success"
+    assert "checkpoint" not in schedule
+    assert db["game_user"].count_documents({"user_id": user_id}) == 5
+    # Ogni titolo è stato risolto una volta sola nonostante i retry
+    assert sorted(igdb_client.lookups) == [f"Game {appid}" for appid in range(1, 6)]
+
+
+def test_sync_fails_when_retries_are_exhausted(sync_env, monkeypatch):
+    db, user_id = sync_env
+    monkeypatch.setattr(worker_sync, "sync_steam", fake_sync_steam(5))
+    monkeypatch.setattr(worker_sync, "SYNC_CHUNK_SIZE", 2)
+    monkeypatch.setattr(worker_sync, "SYNC_DEADLINE_MARGIN", worker_sync.SYNC_JOB_TIMEOUT)
+
+    ctx = {"db": db, "igdb_client": FakeIGDBClient(), "job_try": worker_sync.SYNC_MAX_TRIES}
+    asyncio.run(worker_sync.sync_job(ctx, user_id, "steam", "job-1"))
+
+    schedule = db["schedules"].find_one({"job_string_id": "job-1"})
+    assert schedule["status"] == "fail"
+    assert schedule["checkpoint"]["processed"] == 2
+
+
+def test_retry_skips_written_records_when_the_stream_order_changes(sync_env, monkeypatch):
+    db, user_id = sync_env
+    igdb_client = FakeIGDBClient()
+    # Dopo il primo tentativo l'elenco cambia ordine e compare un gioco appena acquistato
+    orders = [[1, 2, 3, 4], [6, 4, 3, 2, 1]]
+    monkeypatch.setattr(worker_sync, "sync_steam", fake_sync_steam(5, orders))
+    monkeypatch.setattr(worker_sync, "SYNC_CHUNK_SIZE", 2)
+    monkeypatch.setattr(worker_sync, "SYNC_DEADLINE_MARGIN", worker_sync.SYNC_JOB_TIMEOUT)
+
+    ctx = {"db": db, "igdb_client": igdb_client, "job_try": 1}
+    with pytest.raises(Retry):
+        asyncio.run(worker_sync.sync_job(ctx, user_id, "steam", "job-1"))
+    schedule = db["schedules"].find_one({"job_string_id": "job-1"})
+    assert sorted(schedule["checkpoint"]["keys"]) == ["1", "2"]
+
+    monkeypatch.setattr(worker_sync, "SYNC_DEADLINE_MARGIN", 0)
+    ctx = {"db": db, "igdb_client": igdb_client, "job_try": 2}
+    asyncio.run(worker_sync.sync_job(ctx, user_id, "steam", "job-1"))
+
+    assert db["schedules"].find_one({"job_string_id": "job-1"})["status"] == "success"
+    assert db["game_user"].count_documents({"user_id": user_id}) == 5
+    assert sorted(igdb_client.lookups) == [f"Game {appid}" for appid in (1, 2, 3, 4, 6)]
@@ -0,0 +1,102 @@
+import re
+import string
+
+# Campi necessari per riconoscere un gioco già presente durante la sync
+GAME_INDEX_PROJECTION = {
+    "name": 1,
+    "original_name": 1,
+    "normalized_name": 1,
+    "psn_game_id": 1,
+    "steam_game_id": 1,
+    "igdb_id": 1,
+}
+
+TROPHY_SUFFIX_PATTERN = re.compile(r"tro(f|ph)[a-z]*", re.IGNORECASE)
+
+
+def normalize_name(name):
+    if not name:
+        return ""
+    name = name.translate(str.maketrans("", "", string.punctuation))
+    return " ".join(name.lower().split())
+
+
+def clean_name(game_name):
+    if "™" in game_name or "®" in game_name:
+        game_name = game_name.replace("™", "").replace("®", "").strip()
+    match = TROPHY_SUFFIX_PATTERN.search(game_name)
+    if match:
+        game_name = game_name[: match.start()].strip()
+    return game_name
+
+
+class GameIndex:
+    """In-memory lookup over the games collection, built once per sync job.
+
+    Replaces the per-title ``find_one({"$or": [...]})`` on unindexed fields
+    with dictionary lookups over a single projected scan.
+    """
+
+    def __init__(self, games=()):
+        self.by_name = {}
+        self.by_original_name = {}
+        self.by_normalized_name = {}
+        self.by_psn_id = {}
+        self.by_steam_id = {}
+        self.names_lower = set()
+        self.igdb_ids = set()
+        self.name_external_ids = set()
+        for game in games:
+            self.add(game)
+
+    @classmethod
+    def load(cls, db):
+        return cls(db["games"].find({}, GAME_INDEX_PROJECTION))
+
+    def add(self, game):
+        # setdefault keeps the first document seen, like find_one in natural order
+        name = game.get("name")
+        if name:
+            self.by_name.setdefault(name, game)
+            self.names_lower.add(name.lower())
+        if game.get("original_name"):
+            self.by_original_name.setdefault(game["original_name"], game)
+        if game.get("normalized_name"):
+            self.by_normalized_name.setdefault(game["normalized_name"], game)
+        if game.get("psn_game_id") is not None:
+            self.by_psn_id.setdefault(game["psn_game_id"], game)
+        if game.get("steam_game_id") is not None:
+            self.by_steam_id.setdefault(game["steam_game_id"], game)
+        if game.get("igdb_id") is not None:
+            self.igdb_ids.add(game["igdb_id"])
+        if name is not None:
+            self.name_external_ids.add(
+                (name.lower(), game.get("psn_game_id") or game.get("steam_game_id"))
+            )
+
+    def external_ids(self, platform):
+        if platform == "steam":
+            return self.by_steam_id
+        if platform == "psn":
+            return self.by_psn_id
+        return {}
+
+    def find(self, game_name, external_id=None):
+        """Return the first game matching name, original name, normalized name or external id."""
+        game = (
+            self.by_name.get(game_name)
+            or self.by_original_name.get(game_name)
+            or self.by_normalized_name.get(normalize_name(game_name))
+        )
+        if game is None and external_id is not None:
+            game = self.by_psn_id.get(external_id) or self.by_steam_id.get(external_id)
+        return game
+
+
+def load_game_user_index(db, user_id, platform):
+    """Load every game_user row of the user for the platform, keyed by (game_id, platform)."""
+    return {
+        (row.get("game_id"), row.get("platform")): row
+        for row in db["game_user"].find({"user_id": str(user_id), "platform": platform})
+    }
+
@@ -2,13 +2,16 @@
 
 from psnawp_api import PSNAWP
 from tqdm import tqdm
-import pandas as pd
-import numpy as np
 import os
 from psnawp_api.models import SearchDomain
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import time
 import logging
+from dataclasses import replace
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from .rate_limit import TokenBucket
+from .records import PlatformGameRecord
 import sys
 import requests
 from requests.adapters import HTTPAdapter
@@ -32,8 +35,211 @@ def create_robust_session():
     
     return session
 
-def sync_psn(npsso, logger=None):
-    """Sincronizzazione PSN con gestione errori migliorata"""
+def watermark(value):
+    # Salvato come stringa ISO: Mongo perde timezone e microsecondi dei datetime
+    return value.isoformat() if value is not None else None
+
+class PsnSyncState:
+    """Watermark PSN per utente, salvati solo dopo una sync andata a buon fine.
+
+    - `titles`: title_id -> np_communication_id, product_id e ultima data di gioco
+    - `trophies`: np_communication_id -> ultimo aggiornamento del trophy title
+    """
+
+    def __init__(self, collection, user_id):
+        self.collection = collection
+        self.user_id = str(user_id)
+        self.titles = {}
+        self.trophies = {}
+        self.loaded = False
+
+    def load(self):
+        doc = self.collection.find_one({"user_id": self.user_id}) or {}
+        self.titles = {t["title_id"]: t for t in doc.get("titles", [])}
+        self.trophies = {t["np_communication_id"]: t["last_updated"] for t in doc.get("trophies", [])}
+        self.loaded = bool(doc)
+
+    def resolved(self, title_id):
+        """Restituisce gli id già risolti per il titolo, o None"""
+        title = self.titles.get(title_id)
+        if title is None or title.get("np_communication_id") is None:
+            return None
+        return {"np_communication_id": title["np_communication_id"], "product_id": title.get("product_id")}
+
+    def title_changed(self, title_id, last_played):
+        title = self.titles.get(title_id)
+        return title is None or title.get("last_played") != watermark(last_played)
+
+    def trophy_changed(self, np_communication_id, last_updated):
+        return self.trophies.get(np_communication_id, "") != watermark(last_updated)
+
+    def record_title(self, title_id, ids, last_played):
+        self.titles[title_id] = {"title_id": title_id, **ids, "last_played": watermark(last_played)}
+
+    def record_trophy(self, np_communication_id, last_updated):
+        self.trophies[np_communication_id] = watermark(last_updated)
+
+    def save(self):
+        self.collection.update_one(
+            {"user_id": self.user_id},
+            {
+                "$set": {
+                    "titles": list(self.titles.values()),
+                    "trophies": [
+                        {"np_communication_id": np_id, "last_updated": last_updated}
+                        for np_id, last_updated in self.trophies.items()
+                    ],
+                    "synced_at": datetime.now(),
+                }
+            },
+            upsert=True,
+        )
+
+# Risoluzione dei title_id in parallelo, limitata da un token bucket condiviso tra i blocchi
+PSN_RESOLVE_WORKERS = int(os.getenv("PSN_RESOLVE_WORKERS", "4"))
+PSN_RESOLVE_PER_SECOND = float(os.getenv("PSN_RESOLVE_PER_SECOND", "2"))
+PSN_RESOLVE_TIMEOUT = 10
+# Titoli per blocco: i record di un blocco escono appena i suoi title_id sono risolti
+PSN_STREAM_BATCH = int(os.getenv("PSN_STREAM_BATCH", "50"))
+
+UNRESOLVED_TITLE = {"np_communication_id": None, "product_id": None}
+
+class PsnTitleResolver:
+    """Risolve i title_id con `resolve` su un unico pool di `max_workers` thread per sync.
+
+    Pool e token bucket sono creati una volta e usati da tutti i blocchi. Ogni
+    chiamata ha `timeout` secondi dal momento in cui parte: oltre viene
+    considerata fallita e non la si aspetta più, ma il suo thread resta
+    occupato e viene contato anche nei blocchi successivi. Se tutti i thread
+    sono bloccati i titoli rimasti falliscono senza aprirne altri.
+    """
+
+    def __init__(self, resolve, logger, max_workers=PSN_RESOLVE_WORKERS, requests_per_second=PSN_RESOLVE_PER_SECOND, timeout=PSN_RESOLVE_TIMEOUT):
+        self.resolve = resolve
+        self.logger = logger
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.rate_limiter = TokenBucket(requests_per_second)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="psn-resolve")
+        self.timed_out = []
+
+    def stuck(self):
+        self.timed_out = [future for future in self.timed_out if not future.done()]
+        return len(self.timed_out)
+
+    def resolve_titles(self, title_ids):
+        results = {}
+        if not title_ids:
+            return results
+        if self.stuck() >= self.max_workers:
+            self.logger.warning(f"All PSN resolver threads are stuck, skipping {len(title_ids)} titles")
+            return {title_id: UNRESOLVED_TITLE for title_id in title_ids}
+        started_at = {}
+
+        def run(title_id):
+            self.rate_limiter.acquire()
+            started_at[title_id] = time.monotonic()
+            return self.resolve(title_id)
+
+        pending = {self.executor.submit(run, title_id): title_id for title_id in title_ids}
+        try:
+            while pending:
+                done, _ = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[pending.pop(future)] = future.result()
+                now = time.monotonic()
+                for future, title_id in list(pending.items()):
+                    started = started_at.get(title_id)
+                    if started is not None and now - started > self.timeout:
+                        self.logger.warning(f"Timeout getting np_communication_id for title_id {title_id}")
+                        results[pending.pop(future)] = UNRESOLVED_TITLE
+                        self.timed_out.append(future)
+                if pending and self.stuck() >= self.max_workers:
+                    self.logger.warning(f"All PSN resolver threads are stuck, skipping {len(pending)} titles")
+                    break
+        finally:
+            # Le chiamate non ancora partite di questo blocco vengono scartate
+            for future, title_id in pending.items():
+                future.cancel()
+                results[title_id] = UNRESOLVED_TITLE
+        return results
+
+    def close(self):
+        # Non aspetta le chiamate bloccate e scarta quelle non ancora partite
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+# I titoli non risolvibili vengono ritentati dopo questo intervallo
+PSN_TITLE_NEGATIVE_TTL = timedelta(days=1)
+
+class PsnTitleCache:
+    """Cache globale title_id -> np_communication_id / product_id, condivisa da tutti gli utenti.
+
+    Le risoluzioni fallite sono salvate con np_communication_id a None e
+    vengono ritentate solo dopo `negative_ttl`.
+    """
+
+    def __init__(self, collection, negative_ttl=PSN_TITLE_NEGATIVE_TTL):
+        self.collection = collection
+        self.negative_ttl = negative_ttl
+        self._entries = {}
+        self._pending = {}
+
+    def preload(self, title_ids):
+        retry_before = datetime.now() - self.negative_ttl
+        for doc in self.collection.find(
+            {"title_id": {"$in": list(title_ids)}},
+            {"title_id": 1, "np_communication_id": 1, "product_id": 1, "resolved_at": 1},
+        ):
+            if doc.get("np_communication_id") is None and doc["resolved_at"] < retry_before:
+                continue
+            self._entries[doc["title_id"]] = {
+                "np_communication_id": doc.get("np_communication_id"),
+                "product_id": doc.get("product_id"),
+            }
+
+    def get(self, title_id):
+        return self._entries.get(title_id)
+
+    def set(self, title_id, ids):
+        self._entries[title_id] = ids
+        self._pending[title_id] = ids
+
+    def flush(self):
+        if not self._pending:
+            return
+        now = datetime.now()
+        self.collection.bulk_write(
+            [
+                UpdateOne({"title_id": title_id}, {"$set": {**ids, "resolved_at": now}}, upsert=True)
+                for title_id, ids in self._pending.items()
+            ],
+            ordered=False,
+        )
+        self._pending = {}
+
+def trophy_total(trophies):
+    return trophies.bronze + trophies.silver + trophies.gold + trophies.platinum
+
+def psn_console(category):
+    console = category.name
+    if console == "PS5":
+        return 167
+    if console == "PS4":
+        return 48
+    return 9999
+
+def sync_psn(npsso, logger=None, sync_state=None, title_cache=None, batch_size=PSN_STREAM_BATCH):
+    """Sincronizzazione PSN con gestione errori migliorata.
+
+    Qui vengono letti solo l'elenco dei titoli e dei trophy title: `fullGames`
+    è un generatore che risolve i title_id a blocchi di `batch_size` mentre
+    viene consumato e unisce ogni gioco al suo trophy title. I conteggi dei
+    giochi sono aggiornati nel dizionario restituito a fine elenco.
+    Con un `sync_state` già salvato la sync è incrementale: gli id dei titoli
+    noti non vengono risolti di nuovo e `fullGames` contiene solo i trophy
+    title aggiornati o giocati dopo l'ultima sync. I conteggi restano totali.
+    Con una `title_cache` ogni title_id viene risolto una sola volta per tutti gli utenti.
+    """
     if logger is None:
         logger = logging.getLogger()
     
@@ -46,6 +252,13 @@ def sync_psn(npsso, logger=None):
         
         # Profile di npsso owner
         client = psn.me()
+
+        incremental = False
+        if sync_state is not None:
+            sync_state.load()
+            incremental = sync_state.loaded
+            logger.info(f"PSN sync mode: {'incremental' if incremental else 'full'}")
+        changed_np_ids = set()
         
         def get_np_communication_id(title_id):
             try:
@@ -57,86 +270,24 @@ def sync_psn(npsso, logger=None):
                 }
             except Exception as e:
                 logger.warning(f"Error retrieving np_communication_id for title_id {title_id}: {e}")
-                return {"np_communication_id": None, "product_id": None}
-
-        def get_np_communication_id_with_timeout(title_id, timeout=10):
-            with ThreadPoolExecutor(max_workers=1) as executor:
-                future = executor.submit(get_np_communication_id, title_id)
-                try:
-                    return future.result(timeout=timeout)
-                except TimeoutError:
-                    logger.warning(f"Timeout getting np_communication_id for title_id {title_id}")
-                    return {"np_communication_id": None, "product_id": None}
-
-        listOfListGames = []
-        listOfListTrophy = []
-
-        gameCount = 0
-        totPlayTimeCount = 0
-        logger.info("Recupero Dati Giochi: ")
-        print("Recupero Dati Giochi: ", flush=True)
-        
-        # Ottieni statistiche dei giochi
-        try:
-            title_stats = list(client.title_stats())
-            logger.info(f"Found {len(title_stats)} games in title stats")
-            
-            for t in title_stats:
-                logger.info("GAME: Title ID: " + str(t.title_id) + " / Name: " + str(t.name))
-                print("GAME: Title ID: " + str(t.title_id) + " / Name: " + str(t.name), flush=True)
-                
-                ids = get_np_communication_id_with_timeout(t.title_id)
-                np_communication_id = ids["np_communication_id"]
-                product_id = ids["product_id"]
-                
-                console = t.category.name
-                if console == "PS5":
-                    console = 167
-                elif console == "PS4":
-                    console = 48
-                else:
-                    console = 9999
-                
-                listGame = [
-                    t.title_id,
-                    t.name,
-                    t.image_url,
-                    console,
-                    t.play_count,
-                    t.first_played_date_time,
-                    t.last_played_date_time,
-                    t.play_duration,
-                    np_communication_id,
-                    product_id
-                ]
-                
-                if np_communication_id is not None:
-                    listOfListGames.append(listGame)
-                    gameCount += 1
-                    totPlayTimeCount += int(t.play_duration.total_seconds())
-                    
-                time.sleep(2)  # Rate limiting
-                    
-        except Exception as e:
-            logger.error(f"Error getting title stats: {e}")
-            print(f"Error getting title stats: {e}", flush=True)
-
-        np_communication_id_list = [
-            game[8] for game in listOfListGames if game[8] is not None
-        ]
+                return UNRESOLVED_TITLE
 
-        earnedTrophyCount = 0
-        totTrophyCount = 0
-        completeTrophyCount = 0
+        stats = {
+            "gameCount": 0,
+            "earnedTrophyCount": 0,
+            "totTrophyCount": 0,
+            "completeTrophyCount": 0,
+            "totPlayTimeCount": 0,
+        }
         logger.info("Recupero Dati da Trofei: ")
         
-        # Ottieni trofei
+        # Trophy title in ordine di API, chiave np_communication_id
+        trophyRows = {}
         try:
             trophy_titles = list(client.trophy_titles())
             logger.info(f"Found {len(trophy_titles)} trophy titles")
             
             for tr in trophy_titles:
-                product_id = next((game[9] for game in listOfListGames if game[8] == tr.np_communication_id), None)
                 logger.info(
                     "TROPHY: Title ID: "
                     + str(tr.np_communication_id)
@@ -151,142 +302,151 @@ def sync_psn(npsso, logger=None):
                     flush=True,
                 )
                 
-                listGame = [
-                    tr.np_communication_id,
-                    tr.title_name,
-                    (
-                        tr.defined_trophies.bronze
-                        + tr.defined_trophies.silver
-                        + tr.defined_trophies.gold
-                        + tr.defined_trophies.platinum
-                    ),
-                    (
-                        tr.earned_trophies.bronze
-                        + tr.earned_trophies.silver
-                        + tr.earned_trophies.gold
-                        + tr.earned_trophies.platinum
-                    ),
-                    (str(tr.progress) + "%"),
-                ]
-                listOfListTrophy.append(listGame)
-                earnedTrophyCount += (
-                    tr.earned_trophies.bronze
-                    + tr.earned_trophies.silver
-                    + tr.earned_trophies.gold
-                    + tr.earned_trophies.platinum
-                )
-                totTrophyCount += (
-                    tr.defined_trophies.bronze
-                    + tr.defined_trophies.silver
-                    + tr.defined_trophies.gold
-                    + tr.defined_trophies.platinum
-                )
+                trophyRows[tr.np_communication_id] = {
+                    "np_communication_id": tr.np_communication_id,
+                    "title_name": tr.title_name,
+                    "tot_trophies": trophy_total(tr.defined_trophies),
+                    "earned_trophies": trophy_total(tr.earned_trophies),
+                    "perc_trophies": (str(tr.progress) + "%"),
+                }
+                if sync_state is not None:
+                    if sync_state.trophy_changed(tr.np_communication_id, tr.last_updated_datetime):
+                        changed_np_ids.add(tr.np_communication_id)
+                    sync_state.record_trophy(tr.np_communication_id, tr.last_updated_datetime)
+                stats["earnedTrophyCount"] += trophy_total(tr.earned_trophies)
+                stats["totTrophyCount"] += trophy_total(tr.defined_trophies)
                 if tr.earned_trophies.platinum > 0:
-                    completeTrophyCount += 1
+                    stats["completeTrophyCount"] += 1
                     
         except Exception as e:
             logger.error(f"Error getting trophy titles: {e}")
             print(f"Error getting trophy titles: {e}", flush=True)
 
-        # Crea DataFrame con gestione casi vuoti
-        if listOfListTrophy:
-            df_trophy_psn = pd.DataFrame(
-                np.array(listOfListTrophy),
-                columns=[
-                    "np_communication_id",
-                    "title_name",
-                    "totTrophy",
-                    "earnedTrophy",
-                    "percTrophy",
-                ],
+        logger.info("Recupero Dati Giochi: ")
+        print("Recupero Dati Giochi: ", flush=True)
+        
+        # Ottieni statistiche dei giochi: solo l'elenco, gli id si risolvono durante lo stream
+        try:
+            title_stats = list(client.title_stats())
+            logger.info(f"Found {len(title_stats)} games in title stats")
+            if title_cache is not None:
+                title_cache.preload(t.title_id for t in title_stats)
+        except Exception as e:
+            logger.error(f"Error getting title stats: {e}")
+            print(f"Error getting title stats: {e}", flush=True)
+            title_stats = []
+
+        def resolve_batch(resolver, batch):
+            # Id già noti dallo stato utente o dalla cache globale, gli altri risolti in parallelo
+            title_ids = {}
+            for t in batch:
+                ids = sync_state.resolved(t.title_id) if sync_state is not None else None
+                if ids is None and title_cache is not None:
+                    ids = title_cache.get(t.title_id)
+                if ids is not None:
+                    title_ids[t.title_id] = ids
+            unresolved = list(dict.fromkeys(t.title_id for t in batch if t.title_id not in title_ids))
+            if unresolved:
+                logger.info(f"Resolving {len(unresolved)} PSN titles")
+            resolved = resolver.resolve_titles(unresolved)
+            if title_cache is not None:
+                for title_id, ids in resolved.items():
+                    title_cache.set(title_id, ids)
+                # Salvata a ogni blocco, così un retry non risolve di nuovo gli stessi titoli
+                try:
+                    title_cache.flush()
+                except Exception as e:
+                    logger.warning(f"Could not persist PSN title cache: {e}")
+            title_ids.update(resolved)
+            return title_ids
+
+        def game_records():
+            """Unisce ogni trophy title al primo gioco con lo stesso np_communication_id.
+
+            Senza trophy title vengono restituiti i soli giochi; i trophy title
+            senza gioco escono alla fine.
+            """
+            gamesByNpId = {}
+            joined = set()
+            # Un solo pool e un solo rate limiter per tutta la sync, chiusi anche se lo stream si interrompe
+            resolver = PsnTitleResolver(get_np_communication_id, logger)
+            try:
+                for start in range(0, len(title_stats), batch_size):
+                    batch = title_stats[start:start + batch_size]
+                    title_ids = resolve_batch(resolver, batch)
+                    for t in batch:
+                        logger.info("GAME: Title ID: " + str(t.title_id) + " / Name: " + str(t.name))
+                        print("GAME: Title ID: " + str(t.title_id) + " / Name: " + str(t.name), flush=True)
+                        
+                        ids = title_ids[t.title_id]
+                        np_communication_id = ids["np_communication_id"]
+                        if sync_state is not None:
+                            if sync_state.title_changed(t.title_id, t.last_played_date_time):
+                                changed_np_ids.add(np_communication_id)
+                            if np_communication_id is not None:
+                                sync_state.record_title(t.title_id, ids, t.last_played_date_time)
+                        if np_communication_id is None:
+                            continue
+                        
+                        game_record = PlatformGameRecord(
+                            title_id=t.title_id,
+                            name=t.name,
+                            image_url=t.image_url,
+                            console=psn_console(t.category),
+                            play_count=t.play_count,
+                            first_played_date_time=t.first_played_date_time,
+                            last_played_date_time=t.last_played_date_time,
+                            play_duration=t.play_duration,
+                            np_communication_id=np_communication_id,
+                            product_id=ids["product_id"],
+                        )
+                        # Primo titolo per np_communication_id, come il join sui trofei
+                        gamesByNpId.setdefault(np_communication_id, game_record)
+                        stats["gameCount"] += 1
+                        stats["totPlayTimeCount"] += int(t.play_duration.total_seconds())
+                        
+                        # In modalità incrementale si restituiscono solo i titoli cambiati
+                        if incremental and np_communication_id not in changed_np_ids:
+                            continue
+                        if not trophyRows:
+                            yield game_record
+                        elif np_communication_id in trophyRows and np_communication_id not in joined:
+                            joined.add(np_communication_id)
+                            yield replace(gamesByNpId[np_communication_id], **trophyRows[np_communication_id])
+            except Exception as e:
+                logger.error(f"Error getting title stats: {e}")
+                print(f"Error getting title stats: {e}", flush=True)
+            finally:
+                resolver.close()
+
+            for np_communication_id, trophy_row in trophyRows.items():
+                if np_communication_id in gamesByNpId:
+                    continue
+                if not incremental or np_communication_id in changed_np_ids:
+                    yield PlatformGameRecord(**trophy_row)
+
+            print(
+                "Game Count : "
+                + str(stats["gameCount"])
+                + ", Earned Trophy Count : "
+                + str(stats["earnedTrophyCount"])
+                + ", Total Trophy Count : "
+                + str(stats["totTrophyCount"])
+                + ", Complete Trophy Count : "
+                + str(stats["completeTrophyCount"])
             )
-        else:
-            # DataFrame vuoto con le colonne corrette
-            df_trophy_psn = pd.DataFrame(columns=[
-                "np_communication_id",
-                "title_name",
-                "totTrophy",
-                "earnedTrophy",
-                "percTrophy",
-            ])
             
-        if listOfListGames:
-            df_games_psn = pd.DataFrame(
-                np.array(listOfListGames),
-                columns=[
-                    "title_id",
-                    "name",
-                    "image_url",
-                    "console",
-                    "play_count",
-                    "first_played_date_time",
-                    "last_played_date_time",
-                    "play_duration",
-                    "np_communication_id",
-                    "product_id",
-                ],
-            )
-        else:
-            # DataFrame vuoto con le colonne corrette
-            df_games_psn = pd.DataFrame(columns=[
-                "title_id",
-                "name",
-                "image_url",
-                "console",
-                "play_count",
-                "first_played_date_time",
-                "last_played_date_time",
-                "play_duration",
-                "np_communication_id",
-                "product_id",
-            ])
-        
-        # Merge delle tabelle solo se ci sono dati
-        if not df_games_psn.empty and not df_trophy_psn.empty:
-            df_merged = pd.merge(df_games_psn, df_trophy_psn, on="np_communication_id", how="right")
-            df_merged = df_merged.where(pd.notnull(df_merged), None)
-        else:
-            # Se uno dei due DataFrame è vuoto, usa l'altro o crea un DataFrame vuoto
-            if not df_games_psn.empty:
-                df_merged = df_games_psn
-            elif not df_trophy_psn.empty:
-                df_merged = df_trophy_psn
-            else:
-                # Entrambi vuoti, crea un DataFrame vuoto con tutte le colonne
-                df_merged = pd.DataFrame(columns=[
-                    "title_id", "name", "image_url", "console", "play_count",
-                    "first_played_date_time", "last_played_date_time", "play_duration",
-                    "np_communication_id", "product_id", "title_name", "totTrophy",
-                    "earnedTrophy", "percTrophy"
-                ])
-
-        print(
-            "Game Count : "
-            + str(gameCount)
-            + ", Earned Trophy Count : "
-            + str(earnedTrophyCount)
-            + ", Total Trophy Count : "
-            + str(totTrophyCount)
-            + ", Complete Trophy Count : "
-            + str(completeTrophyCount)
-        )
-        
-        logger.info(f"PSN sync completed: {gameCount} games, {earnedTrophyCount} trophies earned")
-        print(f"PSN sync completed: {gameCount} games, {earnedTrophyCount} trophies earned", flush=True)
-        
-        # Se non ci sono giochi, potrebbe essere un profilo privato
-        if gameCount == 0 and earnedTrophyCount == 0:
-            logger.warning("No games or trophies found. This might be a private profile or the user has no games.")
-            print("No games or trophies found. This might be a private profile or the user has no games.", flush=True)
+            logger.info(f"PSN sync completed: {stats['gameCount']} games, {stats['earnedTrophyCount']} trophies earned")
+            print(f"PSN sync completed: {stats['gameCount']} games, {stats['earnedTrophyCount']} trophies earned", flush=True)
+            
+            # Se non ci sono giochi, potrebbe essere un profilo privato
+            if stats["gameCount"] == 0 and stats["earnedTrophyCount"] == 0:
+                logger.warning("No games or trophies found. This might be a private profile or the user has no games.")
+                print("No games or trophies found. This might be a private profile or the user has no games.", flush=True)
         
-        return {
-            "fullGames": df_merged.to_dict(orient="records"),
-            "gameCount": gameCount,
-            "earnedTrophyCount": earnedTrophyCount,
-            "totTrophyCount": totTrophyCount,
-            "completeTrophyCount": completeTrophyCount,
-            "totPlayTimeCount": totPlayTimeCount,
-        }
+        # Join sui trofei tramite dizionario np_communication_id -> gioco, prodotto man mano
+        stats["fullGames"] = game_records()
+        return stats
         
     except Exception as e:
         logger.error(f"PSN sync failed: {e}")
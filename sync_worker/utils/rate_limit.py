@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` calls per second with bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        # Prenota un token e restituisce quanto attendere prima di usarlo
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+# Stesso algoritmo di TokenBucket._reserve, eseguito atomicamente su Redis con il suo orologio.
+# Il risultato è una stringa: Lua troncherebbe un numero restituito a intero
+RESERVE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(state[1]) or capacity
+local updated_at = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + (now - updated_at) * rate) - 1
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+
+class RedisTokenBucket(TokenBucket):
+    """TokenBucket whose tokens live in Redis under `key`, shared by every process using it.
+
+    If Redis is unreachable the bucket falls back to the in-process one, so the
+    limit still holds per process.
+    """
+
+    def __init__(self, redis_client, key, rate, capacity=None):
+        super().__init__(rate, capacity)
+        self.key = key
+        self._script = redis_client.register_script(RESERVE_SCRIPT)
+
+    def _reserve(self):
+        try:
+            return float(self._script(keys=[self.key], args=[self.rate, self.capacity]))
+        except Exception as e:
+            logger.warning(f"Shared rate limit {self.key} unavailable, limiting locally: {e}")
+            return super()._reserve()
+
+    async def acquire_async(self):
+        # La prenotazione è una chiamata Redis sincrona: non va fatta sul loop
+        delay = await asyncio.to_thread(self._reserve)
+        if delay > 0:
+            await asyncio.sleep(delay)
@@ -0,0 +1,32 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional, Union
+
+
+@dataclass(slots=True)
+class PlatformGameRecord:
+    """One library entry produced by a platform tracker, with typed values.
+
+    Steam fills `title_id` with the appid and `play_count` with minutes played;
+    PSN fills the title stats fields and the trophy title joined on
+    `np_communication_id`, any of which may be missing.
+    """
+
+    title_id: Union[int, str, None] = None
+    name: Optional[str] = None
+    title_name: Optional[str] = None
+    play_count: int = 0
+    tot_trophies: int = 0
+    earned_trophies: int = 0
+    perc_trophies: str = "0%"
+    console: Optional[int] = None
+    image_url: Optional[str] = None
+    np_communication_id: Optional[str] = None
+    product_id: Optional[str] = None
+    first_played_date_time: Optional[datetime] = None
+    last_played_date_time: Optional[datetime] = None
+    play_duration: Optional[timedelta] = None
+
+    @property
+    def display_name(self):
+        return self.name if self.name is not None else self.title_name
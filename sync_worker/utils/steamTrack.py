@@ -1,8 +1,6 @@
 # FIX LUIGI
 import requests
 import json
-import numpy as np
-import pandas as pd
 from tqdm import tqdm
 import os
 import logging
@@ -11,11 +9,125 @@ import time
 import urllib3
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from .rate_limit import TokenBucket
+from .records import PlatformGameRecord
 
 # Disabilita gli avvisi SSL per debug
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-def create_robust_session():
+# Richieste achievement in parallelo, limitate da un token bucket condiviso
+STEAM_SYNC_WORKERS = int(os.getenv("STEAM_SYNC_WORKERS", "8"))
+STEAM_REQUESTS_PER_SECOND = float(os.getenv("STEAM_REQUESTS_PER_SECOND", "10"))
+# Giochi per blocco: i record di un blocco escono appena i suoi achievement sono arrivati
+STEAM_STREAM_BATCH = int(os.getenv("STEAM_STREAM_BATCH", "50"))
+
+# Gli schemi achievement cambiano di rado: vengono riverificati dopo questo intervallo
+STEAM_SCHEMA_TTL = timedelta(days=30)
+
+class SteamSchemaCache:
+    """Cache persistente appid -> numero di achievement (GetSchemaForGame), condivisa tra utenti e sync"""
+
+    def __init__(self, collection, ttl=STEAM_SCHEMA_TTL):
+        self.collection = collection
+        self.ttl = ttl
+        self._entries = {}
+        self._pending = {}
+
+    def preload(self, appids):
+        """Carica con una sola query gli schemi ancora validi per gli appid indicati"""
+        fresh_after = datetime.now() - self.ttl
+        for doc in self.collection.find(
+            {"appid": {"$in": list(appids)}, "checked_at": {"$gte": fresh_after}},
+            {"appid": 1, "tot_achievements": 1},
+        ):
+            self._entries[doc["appid"]] = doc["tot_achievements"]
+
+    def get(self, appid):
+        return self._entries.get(appid)
+
+    def set(self, appid, tot_achievements):
+        self._entries[appid] = tot_achievements
+        self._pending[appid] = tot_achievements
+
+    def flush(self):
+        """Scrive in blocco gli schemi recuperati da Steam durante la sync"""
+        if not self._pending:
+            return
+        now = datetime.now()
+        self.collection.bulk_write(
+            [
+                UpdateOne(
+                    {"appid": appid},
+                    {"$set": {"tot_achievements": tot_achievements, "checked_at": now}},
+                    upsert=True,
+                )
+                for appid, tot_achievements in self._pending.items()
+            ],
+            ordered=False,
+        )
+        self._pending = {}
+
+class SteamPlaytimeState:
+    """Ultimo playtime visto per (utente, appid) con gli achievement letti in quel momento.
+
+    Un gioco il cui `playtime_forever` e `rtime_last_played` non sono cambiati
+    dalla sync precedente riusa i conteggi salvati senza interrogare Steam.
+    """
+
+    def __init__(self, collection, user_id):
+        self.collection = collection
+        self.user_id = str(user_id)
+        self._entries = {}
+        self._pending = {}
+
+    def load(self):
+        for doc in self.collection.find(
+            {"user_id": self.user_id},
+            {"appid": 1, "playtime_forever": 1, "rtime_last_played": 1, "tot_achievements": 1, "earned_achievements": 1},
+        ):
+            self._entries[doc["appid"]] = doc
+
+    def unchanged(self, game):
+        """Restituisce (totali, ottenuti) salvati se il gioco non è stato giocato dall'ultima sync"""
+        entry = self._entries.get(game.get('appid'))
+        if entry is None:
+            return None
+        if entry.get("playtime_forever") != game.get('playtime_forever', 0):
+            return None
+        if entry.get("rtime_last_played") != game.get('rtime_last_played', 0):
+            return None
+        return entry.get("tot_achievements", 0), entry.get("earned_achievements", 0)
+
+    def record(self, game, achievements):
+        tot_achievements, earned_achievements = achievements
+        self._pending[game.get('appid')] = {
+            "playtime_forever": game.get('playtime_forever', 0),
+            "rtime_last_played": game.get('rtime_last_played', 0),
+            "tot_achievements": tot_achievements,
+            "earned_achievements": earned_achievements,
+        }
+
+    def flush(self):
+        if not self._pending:
+            return
+        now = datetime.now()
+        self.collection.bulk_write(
+            [
+                UpdateOne(
+                    {"user_id": self.user_id, "appid": appid},
+                    {"$set": {**state, "synced_at": now}},
+                    upsert=True,
+                )
+                for appid, state in self._pending.items()
+            ],
+            ordered=False,
+        )
+        self._pending = {}
+
+def create_robust_session(pool_size=10):
     """Crea una sessione requests con configurazioni robuste per SSL"""
     session = requests.Session()
     
@@ -27,7 +139,7 @@ def create_robust_session():
     )
     
     # Adapter con retry e timeout
-    adapter = HTTPAdapter(max_retries=retry_strategy)
+    adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=pool_size, pool_maxsize=pool_size)
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     
@@ -38,8 +150,10 @@ def create_robust_session():
     
     return session
 
-def steam_api_request(session, url, params=None, timeout=30):
+def steam_api_request(session, url, params=None, timeout=30, rate_limiter=None):
     """Esegue una richiesta all'API Steam con gestione errori robusta"""
+    if rate_limiter is not None:
+        rate_limiter.acquire()
     try:
         # Primo tentativo con SSL normale
         response = session.get(url, params=params, timeout=timeout, verify=True)
@@ -59,16 +173,108 @@ def steam_api_request(session, url, params=None, timeout=30):
         print(f"Request failed: {e}")
         raise
 
-def sync_steam(steam_api_key, steam_id, logger=None):
-    """Sincronizzazione Steam con gestione errori SSL migliorata"""
+def fetch_game_achievements(session, steam_api_key, steam_id, appid, name, logger, rate_limiter=None, schema_cache=None):
+    """Restituisce (achievement totali, achievement ottenuti) per un gioco giocato"""
+    try:
+        # Ottieni achievement totali, dalla cache condivisa se disponibile
+        tot_achievements = schema_cache.get(appid) if schema_cache is not None else None
+        if tot_achievements is None:
+            achievements_url = "https://api.steampowered.com/ISteamUserStats/GetSchemaForGame/v2/"
+            achievements_params = {
+                'key': steam_api_key,
+                'appid': appid
+            }
+            
+            achievements_data = steam_api_request(session, achievements_url, achievements_params, rate_limiter=rate_limiter)
+            game_schema = achievements_data.get('game', {})
+            available_stats = game_schema.get('availableGameStats', {})
+            achievements = available_stats.get('achievements', [])
+            tot_achievements = len(achievements)
+            if schema_cache is not None:
+                schema_cache.set(appid, tot_achievements)
+        
+        # Ottieni achievement ottenuti
+        user_achievements_url = "https://api.steampowered.com/ISteamUserStats/GetPlayerAchievements/v1/"
+        user_achievements_params = {
+            'key': steam_api_key,
+            'steamid': steam_id,
+            'appid': appid
+        }
+        
+        user_achievements_data = steam_api_request(session, user_achievements_url, user_achievements_params, rate_limiter=rate_limiter)
+        player_stats = user_achievements_data.get('playerstats', {})
+        earned_achievements = len([a for a in player_stats.get('achievements', []) if a.get('achieved', 0) == 1])
+        return tot_achievements, earned_achievements
+            
+    except Exception as e:
+        if "403" in str(e):
+            logger.warning(f"Profile may be private or API key insufficient for achievements in {name}. Error: {e}")
+            print(f"Request failed: {e}", flush=True)
+        else:
+            logger.warning(f"Error getting achievements for {name}: {e}")
+        return None
+
+def steam_game_records(games, achievements_by_appid, fetch, logger, max_workers=STEAM_SYNC_WORKERS, batch_size=STEAM_STREAM_BATCH, on_batch=None, on_complete=None):
+    """Genera un PlatformGameRecord per ogni gioco posseduto, nell'ordine della libreria.
+
+    Gli achievement dei giochi giocati che non sono in `achievements_by_appid`
+    vengono chiesti a `fetch` un blocco di `batch_size` giochi alla volta su
+    `max_workers` thread, mentre chi consuma scrive i blocchi precedenti.
+    `on_batch(fetched)` riceve le coppie (gioco, achievement) di ogni blocco,
+    `on_complete()` è chiamato solo quando la libreria è stata letta tutta.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for start in range(0, len(games), batch_size):
+            batch = games[start:start + batch_size]
+            to_fetch = [
+                game for game in batch
+                if game.get('playtime_forever', 0) > 0 and game.get('appid') not in achievements_by_appid
+            ]
+            fetched = list(zip(to_fetch, executor.map(fetch, to_fetch)))
+            for game, achievements in fetched:
+                achievements_by_appid[game.get('appid')] = achievements
+            if on_batch is not None:
+                on_batch(fetched)
+
+            for i, game in enumerate(batch, start=start):
+                appid = game.get('appid')
+                name = game.get('name', 'Unknown')
+                playtime = game.get('playtime_forever', 0)
+                
+                logger.info(f"Processing game {i+1}/{len(games)}: {name} (ID: {appid})")
+                print(f"Processing game {i+1}/{len(games)}: {name} (ID: {appid})", flush=True)
+                
+                record = PlatformGameRecord(title_id=appid, name=name, play_count=playtime)
+                achievements = achievements_by_appid.get(appid) if playtime > 0 else None
+                if achievements is not None:
+                    record.tot_trophies, record.earned_trophies = achievements
+                    if record.tot_trophies > 0:
+                        record.perc_trophies = f"{(record.earned_trophies / record.tot_trophies) * 100:.2f}%"
+                yield record
+    if on_complete is not None:
+        on_complete()
+
+def sync_steam(steam_api_key, steam_id, logger=None, max_workers=STEAM_SYNC_WORKERS, requests_per_second=STEAM_REQUESTS_PER_SECOND, schema_cache=None, playtime_state=None):
+    """Sincronizzazione Steam con gestione errori SSL migliorata.
+
+    Qui vengono letti solo profilo e libreria: `fullGames` è un generatore che
+    recupera gli achievement a blocchi mentre viene consumato, in parallelo su
+    `max_workers` thread che condividono la sessione e un limite di
+    `requests_per_second` richieste verso l'API Steam. I conteggi degli
+    achievement sono aggiornati nel dizionario restituito a fine libreria.
+    Con una `schema_cache` GetSchemaForGame viene chiamato solo per gli appid
+    non ancora noti; con un `playtime_state` vengono interrogati solo i giochi
+    giocati dall'ultima sync.
+    """
     if logger is None:
         logger = logging.getLogger()
     
     logger.info("Starting Steam synchronization with improved SSL handling...")
     print("Starting Steam synchronization with improved SSL handling...", flush=True)
     
-    # Crea sessione robusta
-    session = create_robust_session()
+    # Crea sessione robusta, con un pool grande quanto i thread
+    session = create_robust_session(pool_size=max_workers)
+    rate_limiter = TokenBucket(requests_per_second)
     
     try:
         # 1. Ottieni dettagli utente
@@ -114,100 +320,72 @@ def sync_steam(steam_api_key, steam_id, logger=None):
         logger.info(f"Game Count: {game_count}")
         print(f"Game Count: {game_count}", flush=True)
         
-        listOfList = []
-        totEarnedAchievement = 0
-        totAchievement = 0
-        totPlayTimeCount = 0
+        # 3. Achievement già noti dallo stato utente; gli altri si recuperano durante lo stream
+        played_games = [game for game in games if game.get('playtime_forever', 0) > 0]
+        achievements_by_appid = {}
+        if playtime_state is not None:
+            playtime_state.load()
+            changed_games = []
+            for game in played_games:
+                achievements = playtime_state.unchanged(game)
+                if achievements is None:
+                    changed_games.append(game)
+                else:
+                    achievements_by_appid[game.get('appid')] = achievements
+            logger.info(f"{len(changed_games)}/{len(played_games)} played games changed since last sync")
+            played_games = changed_games
+        if schema_cache is not None:
+            schema_cache.preload(game.get('appid') for game in played_games)
         
-        # 3. Processa ogni gioco
-        for i, game in enumerate(games):
-            appid = game.get('appid')
-            name = game.get('name', 'Unknown')
-            playtime = game.get('playtime_forever', 0)
-            
-            logger.info(f"Processing game {i+1}/{len(games)}: {name} (ID: {appid})")
-            print(f"Processing game {i+1}/{len(games)}: {name} (ID: {appid})", flush=True)
-            
-            listGame = [appid, name, playtime]
-            totPlayTimeCount += playtime
-            
-            # Ottieni achievement solo se il gioco è stato giocato
-            if playtime > 0:
+        def fetch(game):
+            return fetch_game_achievements(
+                session, steam_api_key, steam_id, game.get('appid'), game.get('name', 'Unknown'), logger, rate_limiter, schema_cache
+            )
+
+        def persist_batch(fetched):
+            # Salvati a ogni blocco, così un retry non richiede di nuovo gli achievement già letti
+            if schema_cache is not None:
                 try:
-                    # Ottieni achievement totali
-                    achievements_url = "https://api.steampowered.com/ISteamUserStats/GetSchemaForGame/v2/"
-                    achievements_params = {
-                        'key': steam_api_key,
-                        'appid': appid
-                    }
-                    
-                    achievements_data = steam_api_request(session, achievements_url, achievements_params)
-                    game_schema = achievements_data.get('game', {})
-                    available_stats = game_schema.get('availableGameStats', {})
-                    achievements = available_stats.get('achievements', [])
-                    tot_achievements = len(achievements)
-                    
-                    # Ottieni achievement ottenuti
-                    user_achievements_url = "https://api.steampowered.com/ISteamUserStats/GetPlayerAchievements/v1/"
-                    user_achievements_params = {
-                        'key': steam_api_key,
-                        'steamid': steam_id,
-                        'appid': appid
-                    }
-                    
-                    user_achievements_data = steam_api_request(session, user_achievements_url, user_achievements_params)
-                    player_stats = user_achievements_data.get('playerstats', {})
-                    earned_achievements = len([a for a in player_stats.get('achievements', []) if a.get('achieved', 0) == 1])
-                    
-                    totEarnedAchievement += earned_achievements
-                    totAchievement += tot_achievements
-                    
-                    listGame.append(str(tot_achievements))
-                    listGame.append(str(earned_achievements))
-                    
-                    if tot_achievements > 0:
-                        perc_achievement = (earned_achievements / tot_achievements) * 100
-                        listGame.append(f"{perc_achievement:.2f}%")
-                    else:
-                        listGame.append("0%")
-                        
+                    schema_cache.flush()
                 except Exception as e:
-                    if "403" in str(e):
-                        logger.warning(f"Profile may be private or API key insufficient for achievements in {name}. Error: {e}")
-                        print(f"Request failed: {e}", flush=True)
-                    else:
-                        logger.warning(f"Error getting achievements for {name}: {e}")
-                    listGame.extend(["0", "0", "0%"])
-            else:
-                listGame.extend(["0", "0", "0%"])
-            
-            listOfList.append(listGame)
-            time.sleep(0.5)  # Rate limiting
-        
-        # 4. Crea DataFrame e restituisci risultati
-        arr = np.array(listOfList)
-        df_games_steam = pd.DataFrame(
-            arr,
-            columns=[
-                "title_id",
-                "name", 
-                "play_count",
-                "totTrophy",
-                "earnedTrophy",
-                "percTrophy",
-            ],
-        )
-        
-        logger.info(f"Sync completed: {game_count} games, {totEarnedAchievement} achievements earned")
-        print(f"Sync completed: {game_count} games, {totEarnedAchievement} achievements earned", flush=True)
-        
-        return {
-            "fullGames": df_games_steam.to_dict(orient="records"),
+                    logger.warning(f"Could not persist Steam schema cache: {e}")
+            if playtime_state is not None:
+                for game, achievements in fetched:
+                    # I giochi in errore non vengono salvati e saranno riprovati alla prossima sync
+                    if achievements is not None:
+                        playtime_state.record(game, achievements)
+                try:
+                    playtime_state.flush()
+                except Exception as e:
+                    logger.warning(f"Could not persist Steam playtime state: {e}")
+
+        stats = {
             "gameCount": game_count,
-            "earnedTrophyCount": totEarnedAchievement,
-            "totTrophyCount": totAchievement,
-            "totPlayTimeCount": totPlayTimeCount,
+            "earnedTrophyCount": 0,
+            "totTrophyCount": 0,
+            "totPlayTimeCount": sum(game.get('playtime_forever', 0) for game in games),
         }
+
+        def count_achievements():
+            for game in games:
+                achievements = achievements_by_appid.get(game.get('appid')) if game.get('playtime_forever', 0) > 0 else None
+                if achievements is not None:
+                    stats["totTrophyCount"] += achievements[0]
+                    stats["earnedTrophyCount"] += achievements[1]
+            logger.info(f"Sync completed: {game_count} games, {stats['earnedTrophyCount']} achievements earned")
+            print(f"Sync completed: {game_count} games, {stats['earnedTrophyCount']} achievements earned", flush=True)
+        
+        # 4. I record vengono prodotti, e gli achievement recuperati, man mano che sync_job li consuma
+        stats["fullGames"] = steam_game_records(
+            games,
+            achievements_by_appid,
+            fetch,
+            logger,
+            max_workers=max_workers,
+            on_batch=persist_batch,
+            on_complete=count_achievements,
+        )
+        return stats
         
     except Exception as e:
         logger.error(f"Steam sync failed: {e}")